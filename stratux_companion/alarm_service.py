@@ -1,12 +1,17 @@
 import datetime
 import logging
-from typing import List, NamedTuple
+import threading
+import time
+from collections import deque
+from typing import List, NamedTuple, Dict, Deque, Tuple, Sequence, Optional
 
+from stratux_companion.cpa import Cpa, predict_cpa
 from stratux_companion.hardware_status_service import HardwareStatusService
-from stratux_companion.settings_service import SettingsService
-from stratux_companion.sound_service import SoundServiceWorker, Beeps
-from stratux_companion.traffic_service import TrafficServiceWorker, TrafficInfo
-from stratux_companion.util import GPS, truncate_number, ServiceWorker, Throttle
+from stratux_companion.position_service import PositionServiceWorker
+from stratux_companion.settings_service import SettingsService, Settings
+from stratux_companion.sound_service import SoundServiceWorker, Beeps, SpeechPriority
+from stratux_companion.traffic_service import TrafficServiceWorker, TrafficInfo, TrafficUpdate
+from stratux_companion.util import GPS, truncate_number, ServiceWorker, Throttle, monotonic_ns, Histogram, NS_PER_S
 
 logger = logging.getLogger(__name__)
 
@@ -23,56 +28,194 @@ class AlarmTarget(NamedTuple):
 
 
 class AlarmServiceWorker(ServiceWorker):
+    """
+    Alarm service watches traffic updates and announces traffic that comes too close.
+
+    Traffic is alarming when it is predicted to pass within `cpa_distance_m` in the next `cpa_horizon_s` seconds,
+    or when it is within `max_distance_m` and still closing in. Nearby traffic that is moving away is not announced.
+
+    Alarming traffic is evaluated on every traffic update for updated targets only,
+    and worker is woken up right away to announce targets that start alarming. Every `delay` seconds all traffic
+    is re-evaluated, since ownship could have turned in the meantime, and all alarming traffic is announced again.
+    """
     delay = datetime.timedelta(seconds=15)
 
-    def __init__(self, traffic_service: TrafficServiceWorker, settings_service: SettingsService, sound_service: SoundServiceWorker, hardware_status_service: HardwareStatusService):
+    def __init__(self, traffic_service: TrafficServiceWorker, settings_service: SettingsService, sound_service: SoundServiceWorker, hardware_status_service: HardwareStatusService, position_service: PositionServiceWorker):
         self._hardware_status_service = hardware_status_service
         self._sound_service = sound_service
         self._settings_service = settings_service
         self._traffic_service = traffic_service
+        self._position_service = position_service
 
+        # Guards _alarming, which is updated by traffic service thread and re-evaluated by this worker
+        self._lock = threading.Lock()
+        self._alarming: Dict[str, Tuple[TrafficInfo, Cpa]] = {}
         self._alarming_traffic: List[TrafficInfo] = []
+        self._cpa: Dict[str, Cpa] = {}
+
+        # (icao, time.monotonic() when message that made it alarming was received), appended by traffic service thread
+        self._new_alarms: Deque[Tuple[str, float]] = deque()
+        # time.monotonic() when all alarming traffic was last announced
+        self._announced_t = 0.0
+        # Nanoseconds waited for _lock, from receiving a message to alarm state being updated, and to it being announced
+        self.lock_waits = Histogram()
+        self.alarm_latencies = Histogram()
+        self.announce_latencies = Histogram()
 
         self._battery_alarm_throttle = Throttle(delta=datetime.timedelta(minutes=5))
         self._traffic_beep_throttle = Throttle(delta=datetime.timedelta(seconds=30))
 
-        super().__init__()
-
-    def get_alarming_traffic(self, all_traffic: List[TrafficInfo]) -> List[TrafficInfo]:
-        alarming_traffic: List[TrafficInfo] = []
-
-        max_distance_m = self._settings_service.get_settings().max_distance_m
-        max_altitude_m = self._settings_service.get_settings().max_altitude_m
+        self._settings: Optional[Settings] = None
 
-        for t in all_traffic:
-            if t.distance_m > max_distance_m:
-                continue
-            if t.altitude_m > max_altitude_m:
-                continue
-
-            alarming_traffic.append(t)
+        super().__init__()
 
-        return sorted(alarming_traffic, key=lambda t: t.distance_m)
+        settings_service.subscribe(self._on_settings)
+        traffic_service.subscribe(self._on_traffic_update)
+
+    def _on_settings(self, settings: Settings):
+        self._settings = settings
+        self._sound_service.prerender(self.speech_fragments(settings))
+        # Alarm thresholds could have changed, re-evaluate all traffic
+        self.wake()
+
+    @staticmethod
+    def is_alarming(traffic_info: TrafficInfo, cpa: Cpa, settings: Settings) -> bool:
+        if min(traffic_info.altitude_m, cpa.altitude_m) > settings.max_altitude_m:
+            return False
+        if cpa.distance_m <= settings.cpa_distance_m:
+            return True
+        return cpa.closing and traffic_info.distance_m <= settings.max_distance_m
+
+    def _evaluate(self, targets: Sequence[TrafficInfo], settings: Settings) -> List[Tuple[TrafficInfo, Cpa, bool]]:
+        cpas = predict_cpa(targets, self._position_service.position_info().velocity, settings.cpa_horizon_s, monotonic_ns())
+        return [(t, cpa, self.is_alarming(t, cpa, settings)) for t, cpa in zip(targets, cpas)]
+
+    def histograms(self) -> Dict[str, Histogram]:
+        return {
+            **super().histograms(),
+            'lock_wait_ns': self.lock_waits,
+            'message_to_alarm_ns': self.alarm_latencies,
+            'message_to_announce_ns': self.announce_latencies,
+        }
+
+    def _on_traffic_update(self, update: TrafficUpdate):
+        """
+        Re-evaluate only the traffic that has changed. Runs in traffic service thread.
+        """
+        settings = self._settings
+        evaluated = self._evaluate(update.updated, settings)
+        changed = False
+
+        start_ns = time.perf_counter_ns()
+        with self._lock:
+            self.lock_waits.record(time.perf_counter_ns() - start_ns)
+
+            for traffic_info in update.evicted:
+                changed |= self._alarming.pop(traffic_info.icao, None) is not None
+
+            for traffic_info, cpa, alarming in evaluated:
+                if alarming:
+                    if traffic_info.icao not in self._alarming:
+                        self._new_alarms.append((traffic_info.icao, update.received_t))
+                    self._alarming[traffic_info.icao] = (traffic_info, cpa)
+                    changed = True
+                elif self._alarming.pop(traffic_info.icao, None) is not None:
+                    changed = True
+
+            if changed:
+                self._publish_alarming()
+
+        if update.updated:
+            self.alarm_latencies.record(int((time.monotonic() - update.received_t) * NS_PER_S))
+
+        if self._new_alarms:
+            self.wake()
+
+    def _reevaluate(self):
+        """
+        Evaluate all traffic in current snapshot again, picking up ownship velocity and settings changes
+        """
+        settings = self._settings
+        evaluated = self._evaluate(self._traffic_service.get_snapshot().traffic, settings)
+
+        start_ns = time.perf_counter_ns()
+        with self._lock:
+            self.lock_waits.record(time.perf_counter_ns() - start_ns)
+
+            # Snapshot could be older than the latest update, so traffic updated since then is left as it is
+            for traffic_info, cpa, alarming in evaluated:
+                current = self._alarming.get(traffic_info.icao)
+                if current is not None and current[0].received_ns > traffic_info.received_ns:
+                    continue
+                if alarming:
+                    self._alarming[traffic_info.icao] = (traffic_info, cpa)
+                else:
+                    self._alarming.pop(traffic_info.icao, None)
+
+            # Traffic evicted after snapshot above was taken would be put back by the loop, and never be evaluated again.
+            # Snapshot is published before subscribers are notified, so the current one holds everything alarming.
+            tracked = {traffic_info.icao for traffic_info in self._traffic_service.get_snapshot().traffic}
+            for icao in [icao for icao in self._alarming if icao not in tracked]:
+                del self._alarming[icao]
+
+            self._publish_alarming()
+
+    def _publish_alarming(self):
+        alarming = sorted(self._alarming.values(), key=lambda a: a[1].distance_m)
+        self._alarming_traffic = [traffic_info for traffic_info, _ in alarming]
+        self._cpa = {traffic_info.icao: cpa for traffic_info, cpa in alarming}
 
     def alarming_traffic(self):
         return self._alarming_traffic[:]
 
     def monitor_traffic(self):
-        all_traffic = self._traffic_service.get_closest_traffic()
-        self._alarming_traffic = self.get_alarming_traffic(all_traffic)
+        now = time.monotonic()
+        new_alarms = set()
+        while self._new_alarms:
+            icao, received_t = self._new_alarms.popleft()
+            new_alarms.add(icao)
+            self.announce_latencies.record(int((now - received_t) * NS_PER_S))
+
+        # Waking up for new alarms announces just those, unless all traffic is due to be announced again anyway
+        announce_all = not new_alarms or now - self._announced_t >= self.delay.total_seconds()
+        if announce_all:
+            self._reevaluate()
+            self._announced_t = now
 
         # Play beep every 30s if some traffic is present
-        if all_traffic and not self._alarming_traffic and not self._traffic_beep_throttle.is_throttled:
+        if not self._alarming_traffic and self._traffic_service.get_snapshot().traffic and not self._traffic_beep_throttle.is_throttled:
             self._sound_service.play_beep(Beeps.success)
 
-        if len(self._alarming_traffic) > 4:
-            distances = ', '.join(f'{truncate_number(t.distance_m)} meters' for t in self._alarming_traffic[:5])
-            self._sound_service.play_sound(f"{len(self._alarming_traffic)} targets, {distances}")
-        elif self._alarming_traffic:
-            for t in self._alarming_traffic:
+        alarming_traffic, cpas = self._alarming_traffic, self._cpa
+        if not announce_all:
+            alarming_traffic = [t for t in alarming_traffic if t.icao in new_alarms]
+
+        if len(alarming_traffic) > 4:
+            distances = ', '.join(f'{truncate_number(t.distance_m)} meters' for t in alarming_traffic[:5])
+            self._sound_service.play_sound(f"{len(alarming_traffic)} targets, {distances}", SpeechPriority.traffic, key='traffic')
+        elif alarming_traffic:
+            for t in alarming_traffic:
+                cpa = cpas.get(t.icao)
+                closest = f", closest in {int(cpa.time_s)} seconds" if cpa is not None and cpa.closing and cpa.time_s >= 1 else ''
                 self._sound_service.play_sound(f"{truncate_number(t.distance_m)} meters away, "
                                                f"{truncate_number(t.altitude_m)} meters up, "
-                                               f"at {truncate_number(t.bearing_absolude_dg)} degrees")
+                                               f"at {truncate_number(t.bearing_absolude_dg)} degrees{closest}",
+                                               SpeechPriority.traffic, key=t.icao)
+
+    @staticmethod
+    def speech_fragments(settings: Settings) -> List[str]:
+        """
+        Return fragments of traffic announcements for all values within alarm range, for sound service to prerender
+        """
+        def truncated(limit: int) -> List[int]:
+            return sorted({truncate_number(n) for n in range(limit + 1)})
+
+        return (
+            [f'{n} meters away' for n in truncated(settings.max_distance_m)]
+            + [f'{n} meters up' for n in truncated(settings.max_altitude_m)]
+            + [f'at {n} degrees' for n in truncated(359)]
+            + [f'closest in {n} seconds' for n in range(1, settings.cpa_horizon_s + 1)]
+        )
 
     def monitor_battery(self):
         if self._battery_alarm_throttle.is_throttled:
@@ -80,8 +223,10 @@ class AlarmServiceWorker(ServiceWorker):
 
         current_p = self._hardware_status_service.battery_percent
 
-        if current_p < self._settings_service.get_settings().battery_alarm_p:
-            self._sound_service.play_sound(f'Low battery: {int(current_p)} percent')
+        if current_p < self._settings.battery_alarm_p:
+            minutes = self._hardware_status_service.battery_minutes_remaining
+            remaining = f', {int(minutes)} minutes left' if minutes is not None else ''
+            self._sound_service.play_sound(f'Low battery: {int(current_p)} percent{remaining}', SpeechPriority.system, key='battery')
 
     def trigger(self):
         self.monitor_traffic()
@@ -0,0 +1,108 @@
+from typing import Optional, Tuple
+
+from stratux_companion.util import NS_PER_S
+
+# Resting voltage of a single Li-ion/LiPo cell at 0, 5, ..., 100 percent state of charge
+CELL_DISCHARGE_CURVE: Tuple[float, ...] = (
+    3.27, 3.61, 3.69, 3.71, 3.73, 3.75, 3.77, 3.79, 3.80, 3.82, 3.84,
+    3.85, 3.87, 3.91, 3.95, 3.98, 4.02, 4.08, 4.11, 4.15, 4.20,
+)
+
+# Discharge curve resampled at fixed voltage steps, so looking up charge is a single index
+_LOOKUP_MIN_V = CELL_DISCHARGE_CURVE[0]
+_LOOKUP_MAX_V = CELL_DISCHARGE_CURVE[-1]
+_LOOKUP_STEP_V = 0.01
+
+
+def _build_lookup() -> Tuple[float, ...]:
+    step_p = 100 / (len(CELL_DISCHARGE_CURVE) - 1)
+    lookup = []
+
+    steps = round((_LOOKUP_MAX_V - _LOOKUP_MIN_V) / _LOOKUP_STEP_V)
+    for n in range(steps + 1):
+        v = _LOOKUP_MIN_V + n * _LOOKUP_STEP_V
+        i = 0
+        while i < len(CELL_DISCHARGE_CURVE) - 2 and CELL_DISCHARGE_CURVE[i + 1] < v:
+            i += 1
+        low_v, high_v = CELL_DISCHARGE_CURVE[i], CELL_DISCHARGE_CURVE[i + 1]
+        fraction = min(max((v - low_v) / (high_v - low_v), 0.0), 1.0)
+        lookup.append((i + fraction) * step_p)
+
+    return tuple(lookup)
+
+
+_LOOKUP = _build_lookup()
+
+
+def cell_charge_percent(cell_v: float) -> float:
+    """
+    Return state of charge of a resting cell at `cell_v` volts, interpolated from CELL_DISCHARGE_CURVE
+    """
+    if cell_v <= _LOOKUP_MIN_V:
+        return 0.0
+    if cell_v >= _LOOKUP_MAX_V:
+        return 100.0
+
+    position = (cell_v - _LOOKUP_MIN_V) / _LOOKUP_STEP_V
+    i = int(position)
+    if i + 1 >= len(_LOOKUP):
+        return 100.0
+    return _LOOKUP[i] + (_LOOKUP[i + 1] - _LOOKUP[i]) * (position - i)
+
+
+class BatteryEstimator:
+    """
+    Battery estimator tracks state of charge by counting charge drawn from the battery,
+    and slowly pulls the count towards charge read off the discharge curve, so counting errors do not accumulate.
+
+    Voltage under load sags below resting voltage, so it is compensated with cell internal resistance
+    before being looked up. Voltage alone jumps with every load change, counted charge does not.
+    """
+
+    # Share of the difference between counted and voltage based charge corrected on every update
+    voltage_gain = 0.02
+    # Internal resistance of a single cell, ohms
+    cell_resistance_ohm = 0.05
+    # Below that battery is considered not discharging and there is no time remaining estimate
+    min_discharge_ma = 10.0
+
+    def __init__(self, cells: int, capacity_mah: float):
+        self._cells = cells
+        self._capacity_mah = capacity_mah
+
+        self._charge_percent: Optional[float] = None
+        self._last_ns: Optional[int] = None
+        self._discharge_ma = 0.0
+
+    @property
+    def charge_percent(self) -> Optional[float]:
+        return self._charge_percent
+
+    @property
+    def minutes_remaining(self) -> Optional[float]:
+        """
+        Return minutes until empty at current average discharge, or None if battery is not discharging
+        """
+        if self._charge_percent is None or self._discharge_ma < self.min_discharge_ma:
+            return None
+        return self._charge_percent / 100 * self._capacity_mah / self._discharge_ma * 60
+
+    def update(self, voltage: float, current_ma: float, average_current_ma: float, time_ns: int):
+        """
+        Account for a sample of battery voltage and current drawn from it
+        """
+        cell_v = (voltage + current_ma / 1000 * self.cell_resistance_ohm * self._cells) / self._cells
+        voltage_percent = cell_charge_percent(cell_v)
+        self._discharge_ma = average_current_ma
+
+        if self._charge_percent is None:
+            self._charge_percent = voltage_percent
+            self._last_ns = time_ns
+            return
+
+        hours = (time_ns - self._last_ns) / NS_PER_S / 3600
+        self._last_ns = time_ns
+
+        charge = self._charge_percent - current_ma * hours / self._capacity_mah * 100
+        charge += (voltage_percent - charge) * self.voltage_gain
+        self._charge_percent = min(max(charge, 0.0), 100.0)
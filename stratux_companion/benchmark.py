@@ -0,0 +1,205 @@
+"""
+Performance benchmarks, runnable off the Pi.
+
+Usage:
+    python -m stratux_companion.benchmark decoder traffic.jsonl [traffic.jsonl.2024-01-12 ...]
+    python -m stratux_companion.benchmark render [--targets 0 10 100 1000] [--frames 200]
+"""
+import argparse
+import json
+import random
+import statistics
+import time
+import tracemalloc
+from pathlib import Path
+from typing import List, Callable, Any
+
+from stratux_companion import config
+from stratux_companion.capture_service import open_capture
+from stratux_companion.display import create_dummy
+from stratux_companion.settings_service import Settings
+from stratux_companion.traffic_decoder import available_decoders
+from stratux_companion.traffic_service import TrafficInfo, TrafficSnapshot, build_traffic_info
+from stratux_companion.ui_service import TrafficScreen, AlarmScreen, StatusScreen, Screen
+from stratux_companion.util import GPS, Geodesy, monotonic_ns, RingBuffer, NS_PER_S
+
+
+def read_captures(paths: List[Path]) -> List[str]:
+    """
+    Read raw websocket messages recorded by CaptureServiceWorker
+    """
+    messages = []
+    for path in paths:
+        with open_capture(path) as f:
+            messages.extend(line.rstrip('\n') for line in f if line.strip())
+    return messages
+
+
+def measure(func: Callable[[Any], Any], items: List[Any], repeat: int) -> float:
+    """
+    Return best time in seconds it took to call `func` on every item in `items`
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            func(item)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark_decoder(args):
+    messages = read_captures(args.captures)
+    if not messages:
+        raise SystemExit('No messages found in captures')
+
+    print(f'Messages: {len(messages)}, repeat: {args.repeat}')
+
+    baseline = measure(json.loads, messages, args.repeat)
+    print(f'{"json.loads (full parse)":<24} {len(messages) / baseline:>12.0f} msg/s  1.00x')
+
+    for decoder in available_decoders():
+        t = measure(decoder.decode, messages, args.repeat)
+        print(f'{decoder.name:<24} {len(messages) / t:>12.0f} msg/s  {baseline / t:.2f}x')
+
+
+class SyntheticTraffic:
+    """
+    Stands in for traffic and alarm services, serving a rotating set of precomputed traffic snapshots
+    """
+
+    def __init__(self, targets: int, variants: int = 100):
+        rnd = random.Random(targets)
+        now_ns = monotonic_ns()
+
+        self._snapshots = []
+        for generation in range(variants):
+            traffic = sorted((
+                build_traffic_info(
+                    {
+                        'ExtrapolatedPosition': False,
+                        'Timestamp': '',
+                        'Lat': 30 + rnd.random(),
+                        'Lng': -97 - rnd.random(),
+                        'Alt': rnd.randint(0, 16_000),
+                        'Speed': rnd.randint(25, 215),
+                        'Speed_valid': True,
+                        'Track': rnd.randint(0, 359),
+                        'Vvel': rnd.randint(-1000, 1000),
+                        'Reg': f'N{i}' if i % 2 else '',
+                        'Tail': '',
+                    },
+                    received_ns=now_ns,
+                    fix_ns=now_ns,
+                    icao=str(10_000_000 + i),
+                    geodesy=Geodesy(distance_m=rnd.uniform(0, 50_000), bearing_dg=rnd.uniform(0, 360)),
+                )
+                for i in range(targets)
+            ), key=lambda t: t.distance_m)
+            self._snapshots.append(TrafficSnapshot(
+                messages_seen=generation * targets,
+                traffic=tuple(traffic),
+            ))
+
+        self._n = 0
+
+    def next(self):
+        self._n += 1
+
+    def get_snapshot(self) -> TrafficSnapshot:
+        return self._snapshots[self._n % len(self._snapshots)]
+
+    def alarming_traffic(self) -> List[TrafficInfo]:
+        return [t for t in self.get_snapshot().traffic if t.distance_m <= 10_000 and t.altitude_m <= 3_000]
+
+
+class SyntheticStatus:
+    """
+    Stands in for position and hardware status services
+    """
+    satellites = 9
+    voltage = 15.2
+    power = 4.1
+    battery_percent = 68.0
+    battery_minutes_remaining = 95.0
+    cpu_temp = 51.0
+    cpu_usage = 23.0
+
+    def __init__(self):
+        self._position = Settings().default_position
+        self.samples = 1
+        self.power_history = RingBuffer(300)
+        for n in range(300):
+            self.power_history.append(4.1 + n % 7 / 10, n * NS_PER_S)
+
+    def position_info(self):
+        return self
+
+    def get_current_position(self) -> GPS:
+        return self._position
+
+
+def render_frames(screen: Screen, device, source: SyntheticTraffic, frames: int) -> List[float]:
+    """
+    Render `frames` frames the same way UIServiceWorker does, return per-frame latencies in seconds
+    """
+    latencies = []
+    for _ in range(frames):
+        source.next()
+        start = time.perf_counter()
+        if screen.update():
+            device.display(screen.image)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def benchmark_render(args):
+    device = create_dummy(Settings())
+    status = SyntheticStatus()
+
+    print(f'{"screen":<14} {"targets":>7} {"fps":>9} {"mean ms":>8} {"p95 ms":>8} {"retained B/frame":>17} {"peak KiB":>9}')
+
+    for targets in args.targets:
+        source = SyntheticTraffic(targets)
+        screens = {
+            'TrafficScreen': TrafficScreen(device=device, traffic_service=source),
+            'AlarmScreen': AlarmScreen(device=device, alarm_service=source),
+            'StatusScreen': StatusScreen(device=device, position_service=status, hardware_status_service=status),
+        }
+
+        for name, screen in screens.items():
+            # Warm up caches, then measure time and allocations separately since tracing slows everything down
+            render_frames(screen, device, source, 20)
+            latencies = render_frames(screen, device, source, args.frames)
+
+            # Memory still held after rendering is what frames leave behind, peak includes short lived frame allocations
+            tracemalloc.start()
+            render_frames(screen, device, source, args.frames)
+            retained, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            p95 = sorted(latencies)[int(len(latencies) * 0.95)]
+            print(f'{name:<14} {targets:>7} {len(latencies) / sum(latencies):>9.0f} '
+                  f'{statistics.mean(latencies) * 1000:>8.2f} {p95 * 1000:>8.2f} {retained // args.frames:>17} {peak // 1024:>9}')
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m stratux_companion.benchmark')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    decoder_parser = subparsers.add_parser('decoder', help='Compare traffic message decoders on recorded captures')
+    decoder_parser.add_argument('captures', nargs='*', type=Path, default=[config.ROOT_DIR / 'traffic.jsonl'])
+    decoder_parser.add_argument('--repeat', type=int, default=5)
+    decoder_parser.set_defaults(func=benchmark_decoder)
+
+    render_parser = subparsers.add_parser('render', help='Measure screen rendering on a dummy display device')
+    render_parser.add_argument('--targets', nargs='*', type=int, default=[0, 10, 100, 1000])
+    render_parser.add_argument('--frames', type=int, default=200)
+    render_parser.set_defaults(func=benchmark_render)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
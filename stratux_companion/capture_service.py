@@ -0,0 +1,103 @@
+import datetime
+import gzip
+import io
+import logging
+from collections import deque
+from pathlib import Path
+from typing import Deque, TextIO
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from stratux_companion.util import ServiceWorker, DailyRotatingFile
+
+logger = logging.getLogger(__name__)
+
+
+COMPRESSION_SUFFIXES = {
+    'none': '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+def open_capture(path: Path) -> TextIO:
+    """
+    Open capture file for reading, decompressing it if needed
+    """
+    if path.name.endswith('.gz') or '.gz.' in path.name:
+        return gzip.open(path, 'rt')
+    if path.name.endswith('.zst') or '.zst.' in path.name:
+        if zstandard is None:
+            raise RuntimeError(f'zstandard is required to read {path}')
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(path.open('rb'), read_across_frames=True))
+    return path.open()
+
+
+class CaptureServiceWorker(ServiceWorker):
+    """
+    Capture service writes raw traffic messages to disk, one per line.
+
+    Messages are put into a bounded ring buffer that is drained every `delay` seconds in one batched write,
+    so websocket consumer never waits for SD card. If writes stall long enough for the buffer to fill up,
+    oldest messages are dropped and counted.
+    Capture files are rotated at midnight by DailyRotatingFile.
+    """
+
+    delay = datetime.timedelta(seconds=1)
+
+    def __init__(self, file: Path, compression: str = 'none', capacity: int = 4096, backup_count: int = 5):
+        if compression == 'zstd' and zstandard is None:
+            logger.warning('zstandard is not installed, falling back to gzip compressed traffic capture')
+            compression = 'gzip'
+
+        self._compression = compression
+        self._file = file.with_name(file.name + COMPRESSION_SUFFIXES[compression])
+
+        self._buffer: Deque[str] = deque(maxlen=capacity)
+        self._capacity = capacity
+
+        self._output = DailyRotatingFile(self._file, backup_count)
+
+        self.written = 0
+        self.dropped = 0
+        self._reported_dropped = 0
+
+        super().__init__()
+
+    def capture(self, message_str: str):
+        """
+        Queue message to be written. Never blocks.
+        """
+        if len(self._buffer) == self._capacity:
+            self.dropped += 1
+        self._buffer.append(message_str)
+
+    def trigger(self):
+        lines = []
+        buffer = self._buffer
+        while buffer:
+            lines.append(buffer.popleft())
+
+        if lines:
+            self._write(lines)
+
+        if self.dropped != self._reported_dropped:
+            logger.warning(f'Traffic capture could not keep up and dropped {self.dropped - self._reported_dropped} messages')
+            self._reported_dropped = self.dropped
+
+    def _write(self, lines):
+        data = ('\n'.join(lines) + '\n').encode()
+
+        if self._compression == 'gzip':
+            # Each batch is a separate gzip member, concatenated members are a valid gzip file
+            data = gzip.compress(data, compresslevel=6)
+        elif self._compression == 'zstd':
+            data = zstandard.ZstdCompressor().compress(data)
+
+        stream = self._output.stream()
+        stream.write(data)
+        stream.flush()
+        self.written += len(lines)
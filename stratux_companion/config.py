@@ -2,6 +2,10 @@ from pathlib import Path
 
 ROOT_DIR: Path = Path(__file__).parent.parent
 SETTINGS_FILE = ROOT_DIR / 'settings.json'
+DISPLAY_PNG_FILE = ROOT_DIR / 'display.png'
+TRAFFIC_CAPTURE_FILE = ROOT_DIR / 'traffic.jsonl'
+SPEECH_CACHE_DIR = ROOT_DIR / 'speech_cache'
+METRICS_FILE = ROOT_DIR / 'metrics.jsonl'
 
 
 LOGGING_CONFIG = {
@@ -15,9 +19,6 @@ LOGGING_CONFIG = {
         'short': {
             'format': '%(levelname)s: %(message)s',
         },
-        'jsonl': {
-            'format': '%(message)s',
-        },
     },
     'handlers': {
         'console': {
@@ -32,14 +33,6 @@ LOGGING_CONFIG = {
             'filename': ROOT_DIR / 'stratux_companion.log',
             'backupCount': 5
         },
-        'traffic': {
-            'level': 'DEBUG',
-            'class': 'logging.handlers.TimedRotatingFileHandler',
-            'formatter': 'jsonl',
-            'filename': ROOT_DIR / 'traffic.jsonl',
-            'when': 'midnight',
-            'backupCount': 5
-        },
         'errors': {
             'level': 'ERROR',
             'class': 'logging.handlers.TimedRotatingFileHandler',
@@ -55,11 +48,6 @@ LOGGING_CONFIG = {
             'level': 'DEBUG',
             'propagate': False,
         },
-        'stratux_companion.traffic': {
-            'handlers': ['traffic'],
-            'level': 'DEBUG',
-            'propagate': False,
-        },
     },
     'root': {
         'handlers': ['file'],
@@ -0,0 +1,92 @@
+import math
+from typing import NamedTuple, List, Sequence, TYPE_CHECKING
+
+from stratux_companion.util import NS_PER_S
+
+if TYPE_CHECKING:
+    from stratux_companion.traffic_service import TrafficInfo
+
+
+# Relative speed below this is treated as unknown motion
+_MIN_RELATIVE_SPEED_MS = 0.5
+
+
+class Velocity(NamedTuple):
+    track_dg: float
+    speed_kmh: float
+    vertical_speed_ms: float
+
+
+class Cpa(NamedTuple):
+    """
+    Closest point of approach between ownship and a target, assuming both keep their track and speed
+    """
+    # Seconds until closest point of approach, clamped to prediction horizon. 0 if it is already behind
+    time_s: float
+    # Horizontal separation at closest point of approach
+    distance_m: float
+    # Target altitude at closest point of approach
+    altitude_m: float
+    # Range is decreasing, or relative motion is unknown
+    closing: bool
+
+
+def predict_cpa(targets: Sequence['TrafficInfo'], ownship: Velocity, horizon_s: float, now_ns: int) -> List[Cpa]:
+    """
+    Predict closest point of approach within `horizon_s` from `now_ns` for every target, in the same order as `targets`.
+
+    Geometry is solved on a flat plane tangent at ownship, using target distance and bearing.
+    At distances we alarm on (tens of kilometers) that is accurate to a few meters.
+    Target positions are first moved forward from the moment they were reported for to `now_ns`.
+    Targets without valid speed could be heading anywhere, so they are closing at their current distance.
+    """
+    sin, cos, radians = math.sin, math.cos, math.radians
+
+    own_track = radians(ownship.track_dg)
+    own_speed_ms = ownship.speed_kmh / 3.6
+    own_vx = own_speed_ms * sin(own_track)
+    own_vy = own_speed_ms * cos(own_track)
+
+    result = []
+
+    for t in targets:
+        if not t.speed_valid:
+            result.append(Cpa(time_s=0.0, distance_m=float(t.distance_m), altitude_m=float(t.altitude_m), closing=True))
+            continue
+
+        bearing = radians(t.bearing_absolude_dg)
+        px = t.distance_m * sin(bearing)
+        py = t.distance_m * cos(bearing)
+
+        track = radians(t.track_dg)
+        speed_ms = t.speed_kmh / 3.6
+        target_vx = speed_ms * sin(track)
+        target_vy = speed_ms * cos(track)
+
+        age_s = max((now_ns - t.position_ns) / NS_PER_S, 0.0)
+        px += target_vx * age_s
+        py += target_vy * age_s
+
+        vx = target_vx - own_vx
+        vy = target_vy - own_vy
+
+        v2 = vx * vx + vy * vy
+        if v2 < _MIN_RELATIVE_SPEED_MS ** 2:
+            result.append(Cpa(time_s=0.0, distance_m=math.hypot(px, py), altitude_m=float(t.altitude_m), closing=True))
+            continue
+
+        time_s = -(px * vx + py * vy) / v2
+        closing = time_s > 0
+        time_s = min(max(time_s, 0.0), horizon_s)
+
+        cx = px + vx * time_s
+        cy = py + vy * time_s
+
+        result.append(Cpa(
+            time_s=time_s,
+            distance_m=math.hypot(cx, cy),
+            altitude_m=t.altitude_m + t.vertical_speed_ms * (age_s + time_s),
+            closing=closing,
+        ))
+
+    return result
@@ -0,0 +1,72 @@
+import logging
+from pathlib import Path
+
+from luma.core.device import dummy
+
+from stratux_companion import config
+from stratux_companion.settings_service import Settings
+
+logger = logging.getLogger(__name__)
+
+DISPLAY_WIDTH = 128
+DISPLAY_HEIGHT = 128
+
+
+class png_dump(dummy):
+    """
+    Pseudo-device that writes every displayed frame to a PNG file, overwriting the previous one.
+    Handy to look at the UI without the display attached.
+    """
+
+    def __init__(self, file: Path, **kwargs):
+        super().__init__(**kwargs)
+        self._file = file
+
+    def display(self, image):
+        super().display(image)
+        self.image.save(self._file)
+
+
+def create_st7735(settings: Settings):
+    # Imported here so other devices can be used on machines without SPI/GPIO
+    from luma.core.interface.serial import spi
+    from luma.lcd.device import st7735
+
+    serial = spi(port=0, device=0, gpio_DC=24, gpio_RST=25)
+    device = st7735(
+        serial_interface=serial,
+        width=DISPLAY_WIDTH,
+        height=DISPLAY_HEIGHT,
+        v_offset=2,
+        h_offset=1,
+        bgr=True,
+        rotate=settings.display_rotation,
+        gpio_LIGHT=23,
+        active_low=False
+    )
+    device.clear()
+    device.backlight(True)
+    return device
+
+
+def create_dummy(settings: Settings):
+    return dummy(width=DISPLAY_WIDTH, height=DISPLAY_HEIGHT, rotate=settings.display_rotation, mode='RGB')
+
+
+def create_png_dump(settings: Settings):
+    return png_dump(file=config.DISPLAY_PNG_FILE, width=DISPLAY_WIDTH, height=DISPLAY_HEIGHT, rotate=settings.display_rotation, mode='RGB')
+
+
+DEVICES = {
+    'st7735': create_st7735,
+    'dummy': create_dummy,
+    'png': create_png_dump,
+}
+
+
+def create_device(settings: Settings):
+    """
+    Create luma display device selected by `display_device` setting
+    """
+    logger.debug(f'Using {settings.display_device} display device')
+    return DEVICES[settings.display_device](settings)
@@ -1,15 +1,20 @@
+import asyncio
 import logging.config
 from threading import Thread
 from typing import Callable
 
 from stratux_companion import config
 from stratux_companion.alarm_service import AlarmServiceWorker
+from stratux_companion.capture_service import CaptureServiceWorker
 from stratux_companion.position_service import PositionServiceWorker
 from stratux_companion.hardware_status_service import HardwareStatusService
+from stratux_companion.metrics_service import MetricsServiceWorker
 from stratux_companion.settings_service import SettingsService
+from stratux_companion.settings_watcher import SettingsWatcherWorker
 from stratux_companion.sound_service import SoundServiceWorker
 from stratux_companion.traffic_service import TrafficServiceWorker
 from stratux_companion.ui_service import UIServiceWorker
+from stratux_companion.util import ServiceWorker
 
 logger = logging.getLogger(__name__)
 
@@ -25,17 +30,26 @@ def run_and_wait(*targets: Callable[[], None]):
         thread.join()
 
 
+async def run_async_and_wait(*workers: ServiceWorker):
+    await asyncio.gather(*(worker.run_async() for worker in workers))
+
+
 def main():
     settings_service = SettingsService(
         settings_file=config.SETTINGS_FILE
     )
 
+    settings_watcher = SettingsWatcherWorker(
+        settings_service=settings_service
+    )
+
     hardware_status_service = HardwareStatusService(
         settings_service=settings_service
     )
 
     sound_service = SoundServiceWorker(
-        settings_service=settings_service
+        settings_service=settings_service,
+        speech_cache_dir=config.SPEECH_CACHE_DIR,
     )
 
     position_service = PositionServiceWorker(
@@ -43,9 +57,15 @@ def main():
         sound_service=sound_service
     )
 
+    capture_service = CaptureServiceWorker(
+        file=config.TRAFFIC_CAPTURE_FILE,
+        compression=settings_service.get_settings().traffic_capture_compression,
+    )
+
     traffic_service = TrafficServiceWorker(
         settings_service=settings_service,
         position_service=position_service,
+        capture_service=capture_service,
     )
 
     alarm_interface = AlarmServiceWorker(
@@ -53,6 +73,7 @@ def main():
         traffic_service=traffic_service,
         sound_service=sound_service,
         hardware_status_service=hardware_status_service,
+        position_service=position_service,
     )
 
     ui_service = UIServiceWorker(
@@ -63,13 +84,28 @@ def main():
         hardware_status_service=hardware_status_service,
     )
 
-    run_and_wait(
-        ui_service.run,
-        traffic_service.run,
-        sound_service.run,
-        alarm_interface.run,
-        position_service.run,
-    )
+    workers = [
+        ui_service,
+        traffic_service,
+        capture_service,
+        sound_service,
+        alarm_interface,
+        position_service,
+        hardware_status_service,
+        settings_watcher,
+    ]
+
+    workers.append(MetricsServiceWorker(
+        settings_service=settings_service,
+        workers=workers[:],
+        file=config.METRICS_FILE,
+    ))
+
+    if settings_service.get_settings().runtime == 'asyncio':
+        logger.info('Running services in asyncio event loop')
+        asyncio.run(run_async_and_wait(*workers))
+    else:
+        run_and_wait(*(worker.run for worker in workers))
 
 
 if __name__ == '__main__':
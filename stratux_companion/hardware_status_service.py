@@ -1,18 +1,35 @@
+import datetime
+import logging
 from pathlib import Path
+from typing import Optional
 
 import board
 import psutil
 from adafruit_ina219 import INA219, BusVoltageRange, ADCResolution
 
-from stratux_companion.settings_service import SettingsService
+from stratux_companion.battery import BatteryEstimator
+from stratux_companion.settings_service import SettingsService, Settings
+from stratux_companion.util import ServiceWorker, RingBuffer, monotonic_ns
 
+logger = logging.getLogger(__name__)
 
-class HardwareStatusService:
+
+class HardwareStatusService(ServiceWorker):
     """
     Power service uses i2c INA219 DC current sensor to provide information about source power (upstream of BECs)
+
+    Sensors are sampled every `hardware_sample_s` seconds into fixed size histories.
+    Properties return the latest sample and never touch the bus themselves.
+    Battery state of charge is estimated from the same samples by BatteryEstimator.
     """
+
+    # Number of samples kept in each history
+    history_size = 300
+
     def __init__(self, settings_service: SettingsService):
         self._settings_service = settings_service
+        settings = settings_service.get_settings()
+        settings_service.subscribe(self._on_settings)
 
         i2c_bus = board.I2C()  # uses board.SCL and board.SDA
         self._ina219 = INA219(i2c_bus)
@@ -22,58 +39,97 @@ class HardwareStatusService:
         self._ina219.shunt_adc_resolution = ADCResolution.ADCRES_12BIT_32S
         self._ina219.bus_voltage_range = BusVoltageRange.RANGE_16V
 
+        self.voltage_history = RingBuffer(self.history_size)
+        self.current_history = RingBuffer(self.history_size)
+        self.power_history = RingBuffer(self.history_size)
+        self.cpu_temp_history = RingBuffer(self.history_size)
+        self.cpu_usage_history = RingBuffer(self.history_size)
+
+        # Number of samples taken, tells readers if there is anything new
+        self.samples = 0
+
+        self._battery = BatteryEstimator(cells=settings.battery_cells, capacity_mah=settings.battery_capacity_mah)
+
+        super().__init__()
+
+        self.trigger()
+
+    def _on_settings(self, settings: Settings):
+        self.delay = datetime.timedelta(seconds=settings.hardware_sample_s)
+
+    def trigger(self):
+        now_ns = monotonic_ns()
+
+        self.voltage_history.append(self._ina219.bus_voltage, now_ns)
+        self.current_history.append(self._ina219.current, now_ns)
+        self.power_history.append(self._ina219.power, now_ns)
+        self.cpu_temp_history.append(self._read_cpu_temp(), now_ns)
+        # Utilization since previous sample
+        self.cpu_usage_history.append(psutil.cpu_percent(), now_ns)
+
+        self._battery.update(
+            voltage=self.voltage_history.last,
+            current_ma=self.current_history.last,
+            average_current_ma=self.current_history.mean(),
+            time_ns=now_ns,
+        )
+
+        self.samples += 1
+
     @property
     def voltage(self) -> float:
         """
         Return Voltage reading
         """
-        return self._ina219.bus_voltage
+        return self.voltage_history.last
 
     @property
     def current(self) -> float:
         """
         Return Current mAh reading
         """
-        return self._ina219.current
+        return self.current_history.last
 
     @property
     def power(self) -> float:
         """
         Return Power Watts reading
         """
-        return self._ina219.power
+        return self.power_history.last
 
     @property
     def battery_percent(self) -> float:
         """
-        Return current battery volatage as percents of maximum voltage
+        Return estimated battery state of charge, percents
         """
-        cells = self._settings_service.get_settings().battery_cells
-        min_v = 3.0 * cells
-        max_v = 4.2 * cells
+        return self._battery.charge_percent
 
-        max_diff = max_v - min_v
-        diff = max_v - self.voltage
-
-        return 100 - (diff / max_diff) * 100
+    @property
+    def battery_minutes_remaining(self) -> Optional[float]:
+        """
+        Return estimated minutes until battery is empty at recent average power draw, None if it is not discharging
+        """
+        return self._battery.minutes_remaining
 
     @property
     def cpu_temp(self) -> float:
         """
         Return CPU Temperature Celsius (i am metric guy)
         """
-        temp_reading = Path('/sys/class/thermal/thermal_zone0/temp').read_text()
-
-        try:
-            temp = int(temp_reading) / 1000
-        except:
-            temp = 0.0
-
-        return temp
+        return self.cpu_temp_history.last
 
     @property
     def cpu_usage(self) -> float:
         """
         Return CPU Utilization percents
         """
-        return psutil.cpu_percent()
+        return self.cpu_usage_history.last
+
+    @staticmethod
+    def _read_cpu_temp() -> float:
+        try:
+            temp = int(Path('/sys/class/thermal/thermal_zone0/temp').read_text()) / 1000
+        except (OSError, ValueError):
+            temp = 0.0
+
+        return temp
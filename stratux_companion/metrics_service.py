@@ -0,0 +1,97 @@
+import datetime
+import json
+import logging
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from threading import Thread
+from typing import Sequence
+
+from stratux_companion.settings_service import SettingsService, Settings
+from stratux_companion.util import ServiceWorker, monotonic_ns, NS_PER_S, DailyRotatingFile
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsServiceWorker(ServiceWorker):
+    """
+    Metrics service collects histograms of every worker every `metrics_interval_s` seconds
+    and appends them to metrics file as a JSON line. Histograms are reset once collected,
+    so every line describes its own interval only. Metrics file is rotated at midnight.
+
+    Bucket bounds are not repeated on every line: histograms named `*_ns` use util.DURATION_BOUNDS_NS,
+    the others util.DEPTH_BOUNDS.
+
+    Latest line is also served over HTTP on localhost at `metrics_port`, unless it is 0:
+        curl http://127.0.0.1:8091/
+    """
+
+    def __init__(self, settings_service: SettingsService, workers: Sequence[ServiceWorker], file: Path, backup_count: int = 5):
+        self._workers = workers
+        self._output = DailyRotatingFile(file, backup_count, mode='a')
+
+        self._last_line = b'{}\n'
+        self._last_ns = monotonic_ns()
+
+        settings_service.subscribe(self._on_settings)
+
+        port = settings_service.get_settings().metrics_port
+        if port:
+            self._serve(port)
+
+        super().__init__()
+
+    def _on_settings(self, settings: Settings):
+        self.delay = datetime.timedelta(seconds=settings.metrics_interval_s)
+
+    def trigger(self):
+        now_ns = monotonic_ns()
+        metrics = {
+            'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'interval_s': round((now_ns - self._last_ns) / NS_PER_S, 3),
+            'workers': {
+                worker.__class__.__name__: {
+                    'heartbeat_age_s': None if worker.heartbeat is None else round((now_ns - worker.heartbeat) / NS_PER_S, 3),
+                    **{name: histogram.snapshot(reset=True) for name, histogram in worker.histograms().items()},
+                }
+                for worker in self._workers
+            },
+        }
+        self._last_ns = now_ns
+
+        line = json.dumps(metrics, separators=(',', ':')) + '\n'
+        self._last_line = line.encode()
+
+        stream = self._output.stream()
+        stream.write(line)
+        stream.flush()
+
+    def _serve(self, port: int):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = service._last_line
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            server = HTTPServer(('127.0.0.1', port), Handler)
+        except OSError as e:
+            logger.error(f'Error serving metrics on port {port}: {e}')
+            return
+
+        Thread(target=self._handle_requests, args=(server,), name='metrics', daemon=True).start()
+        logger.info(f'Serving metrics at http://127.0.0.1:{port}/')
+
+    @staticmethod
+    def _handle_requests(server: HTTPServer):
+        # Requests are handled one by one, blocking in between without waking up
+        server.timeout = None
+        while True:
+            server.handle_request()
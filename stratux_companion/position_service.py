@@ -1,13 +1,22 @@
 import datetime
+import json
 import logging
 from typing import Optional, NamedTuple
 
 import requests
 from geopy.units import meters
+from websockets import ConnectionClosed
+from websockets.sync.client import connect
 
-from stratux_companion.settings_service import SettingsService
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+from stratux_companion.cpa import Velocity
+from stratux_companion.settings_service import SettingsService, Settings
 from stratux_companion.sound_service import SoundServiceWorker, Beeps
-from stratux_companion.util import GPS, ServiceWorker
+from stratux_companion.util import GPS, ServiceWorker, km_h, monotonic_ns, NS_PER_S
 
 logger = logging.getLogger(__name__)
 
@@ -71,42 +80,164 @@ class PositionInfo(NamedTuple):
     altitude_hae_m: int  # Height above WGS84 ellipsoid
     satellites: int
 
+    track_dg: float = 0.0  # True course
+    ground_speed_kmh: float = 0.0
+    vertical_speed_ms: float = 0.0
+
     @property
     def is_valid(self):
         return self.satellites > 0
 
+    @property
+    def velocity(self) -> Velocity:
+        return Velocity(track_dg=self.track_dg, speed_kmh=self.ground_speed_kmh, vertical_speed_ms=self.vertical_speed_ms)
+
+
+class PositionFix(NamedTuple):
+    """
+    Last situation reported by stratux. Replaced as a whole, so readers in other threads never see parts of two fixes.
+    """
+    # Last valid position, None until there is one
+    position: Optional[GPS]
+    # util.monotonic_ns() when position was received
+    position_ns: int
+    info: PositionInfo
+
+
+if msgspec is not None:
+    class _SituationMessage(msgspec.Struct):
+        """
+        Fields of SituationData used by PositionServiceWorker, the rest of the message is skipped while decoding
+        """
+        GPSLatitude: float
+        GPSLongitude: float
+        GPSAltitudeMSL: float
+        GPSHeightAboveEllipsoid: float
+        GPSSatellites: int
+        GPSTrueCourse: float = 0.0
+        GPSGroundSpeed: float = 0.0
+        GPSVerticalSpeed: float = 0.0
+
+    _situation_decoder = msgspec.json.Decoder(type=_SituationMessage)
+
+    def decode_situation(message_str: str) -> dict:
+        return msgspec.structs.asdict(_situation_decoder.decode(message_str))
+else:
+    def decode_situation(message_str: str) -> dict:
+        return json.loads(message_str)
+
 
 class PositionServiceWorker(ServiceWorker):
     """
     Position service interfaces with startux /getSituation endpoint and provides current GPS coordinates
+
+    Between polls current position is dead reckoned from last fix using its true course and ground speed.
+    Stratux is polled often while moving and rarely while standing still, or when it is not reachable.
+
+    With `situation_source` set to websocket, situation is streamed from stratux /situation websocket endpoint
+    at GPS sample rate instead. When it can not connect or the connection is lost, it falls back to polling until reconnected.
     """
 
-    # Delay between attempts to connect to stratux
+    # Delay between polls on the ground, and between attempts to connect to stratux
     delay = datetime.timedelta(seconds=30)
+    # Delay between polls while moving faster than `moving_speed_kmh`
+    moving_delay = datetime.timedelta(seconds=2)
+    moving_speed_kmh = 30
+
+    request_timeout = datetime.timedelta(seconds=10)
+
+    # Stratux pushes situation many times a second, so silence that long means stream is stuck
+    message_timeout = datetime.timedelta(seconds=5)
+
+    # Past that, extrapolated position is more wrong than the last fix, so stop extrapolating
+    max_dead_reckoning = datetime.timedelta(seconds=60)
 
     def __init__(self, settings_service: SettingsService, sound_service: SoundServiceWorker):
-        self._current_position: Optional[GPS] = None
-        self._position_info = PositionInfo(
-            altitude_hae_m=0,
-            altitude_msl_m=0,
-            satellites=0
+        self._fix = PositionFix(
+            position=None,
+            position_ns=0,
+            info=PositionInfo(
+                altitude_hae_m=0,
+                altitude_msl_m=0,
+                satellites=0
+            ),
         )
         self._settings_service = settings_service
         self._sound_service = sound_service
 
+        # Keeps connection to stratux alive between polls
         self._session = requests.Session()
+        self._etag: Optional[str] = None
+
+        self._default_position: Optional[GPS] = None
+        settings_service.subscribe(self._on_settings)
 
         super().__init__()
 
+    def _on_settings(self, settings: Settings):
+        self._default_position = settings.default_position
+
     def trigger(self):
-        situation_response = self._session.get(self._settings_service.get_settings().situation_endpoint, timeout=self.delay.total_seconds())
+        # Poll slowly until stratux answers and reports we are moving
+        self.delay = self.__class__.delay
+
+        settings = self._settings_service.get_settings()
+
+        if settings.situation_source == 'websocket':
+            try:
+                self._stream_situation(settings.situation_websocket_endpoint)
+            except Exception as e:
+                logger.warning(f'Error streaming situation from {settings.situation_websocket_endpoint}, falling back to polling: {e}')
+
+            if self._shutdown:
+                return
+
+        self._poll_situation(settings.situation_endpoint)
+
+    def _poll_situation(self, endpoint: str):
+        headers = {'If-None-Match': self._etag} if self._etag else {}
+        situation_response = self._session.get(endpoint, headers=headers, timeout=self.request_timeout.total_seconds())
+        if situation_response.status_code == 304:
+            self._adapt_delay()
+            return
+
         situation_response.raise_for_status()
-        situation_data = situation_response.json()
+        self._etag = situation_response.headers.get('ETag')
+        self._update_situation(situation_response.json())
+
+    def _stream_situation(self, endpoint: str):
+        """
+        Update situation from every websocket message until shutdown or connection is lost
+        """
+        logger.debug(f'Trying to connect to stratux /situation endpoint at {endpoint}')
+        with connect(endpoint, open_timeout=self.request_timeout.total_seconds()) as websocket:
+            logger.info('Successfully connected to stratux /situation endpoint')
+            while not self._shutdown:
+                settings = self._settings_service.get_settings()
+                if settings.situation_source != 'websocket' or settings.situation_websocket_endpoint != endpoint:
+                    logger.info('Situation source changed, disconnecting from stratux /situation endpoint')
+                    return
+
+                try:
+                    message_str = websocket.recv(timeout=self.message_timeout.total_seconds())
+                except TimeoutError:
+                    logger.warning('No situation updates from stratux /situation endpoint')
+                    return
+                except ConnectionClosed:
+                    logger.warning('Situation websocket connection unexpectedly closed')
+                    return
 
-        self._position_info = PositionInfo(
+                self._update_situation(decode_situation(message_str))
+                self._update_heartbeat()
+
+    def _update_situation(self, situation_data: dict):
+        position_info = PositionInfo(
             altitude_msl_m=int(meters(feet=situation_data['GPSAltitudeMSL'])),
             altitude_hae_m=int(meters(feet=situation_data['GPSHeightAboveEllipsoid'])),
-            satellites=situation_data['GPSSatellites']
+            satellites=situation_data['GPSSatellites'],
+            track_dg=situation_data.get('GPSTrueCourse', 0.0),
+            ground_speed_kmh=km_h(situation_data.get('GPSGroundSpeed', 0.0)),
+            vertical_speed_ms=meters(feet=situation_data.get('GPSVerticalSpeed', 0.0)),
         )
 
         new_position = GPS(
@@ -116,19 +247,34 @@ class PositionServiceWorker(ServiceWorker):
 
         if not new_position.is_valid:
             logger.debug('Reported position is not valid')
+            self._fix = self._fix._replace(info=position_info)
             return
 
-        if self._current_position is None:
+        if self._fix.position is None:
             self._sound_service.play_beep(Beeps.info)
 
-        self._current_position = new_position
-        logger.debug(f'Current position: {self._current_position}')
-        logger.debug(f'Position info: {self._position_info}')
+        self._fix = PositionFix(position=new_position, position_ns=monotonic_ns(), info=position_info)
+        self._adapt_delay()
+        logger.debug(f'Current position: {new_position}')
+        logger.debug(f'Position info: {position_info}')
+
+    def _adapt_delay(self):
+        if self._fix.info.ground_speed_kmh >= self.moving_speed_kmh:
+            self.delay = self.moving_delay
 
     def get_current_position(self) -> GPS:
-        if self._current_position is None or not self._current_position.is_valid:
-            return self._settings_service.get_settings().default_position
-        return self._current_position
+        fix = self._fix
+        if fix.position is None or not fix.position.is_valid:
+            return self._default_position
+        return self._dead_reckon(fix.position, fix.info, (monotonic_ns() - fix.position_ns) / NS_PER_S)
+
+    def _dead_reckon(self, position: GPS, position_info: PositionInfo, age_s: float) -> GPS:
+        """
+        Extrapolate `position` by `age_s` seconds along its true course and ground speed
+        """
+        if position_info.ground_speed_kmh <= 0 or age_s <= 0 or age_s > self.max_dead_reckoning.total_seconds():
+            return position
+        return position.destination(position_info.track_dg, position_info.ground_speed_kmh / 3.6 * age_s)
 
     def position_info(self) -> PositionInfo:
-        return self._position_info
+        return self._fix.info
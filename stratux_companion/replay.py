@@ -0,0 +1,366 @@
+"""
+Replay recorded traffic.jsonl captures through the real traffic, position and alarm services.
+
+Local websocket server stands in for stratux /traffic endpoint and local http server for /getSituation.
+Messages are sent with their original pacing divided by `--speed`, or as fast as possible with `--speed 0`.
+Services run on a fake clock that follows capture time, so traffic expiry and throttles behave as they did when recorded.
+
+Usage:
+    python -m stratux_companion.replay traffic.jsonl [more captures ...] [--speed 10] [--position 30.45,-97.68]
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import resource
+import statistics
+import tempfile
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from threading import Thread, Event
+from typing import List, NamedTuple, Dict, Optional
+
+from websockets import ConnectionClosed
+from websockets.sync.server import serve
+
+from stratux_companion import config
+from stratux_companion.alarm_service import AlarmServiceWorker
+from stratux_companion.benchmark import read_captures
+from stratux_companion.cpa import predict_cpa, Velocity
+from stratux_companion.position_service import PositionServiceWorker
+from stratux_companion.settings_service import SettingsService, Settings
+from stratux_companion.sound_service import SoundServiceWorker
+from stratux_companion.traffic_decoder import JsonTrafficDecoder
+from stratux_companion.traffic_service import TrafficServiceWorker, build_traffic_info
+from stratux_companion.util import GPS, inverse_batch, FakeClock, set_clock, parse_timestamp, Histogram, NS_PER_S
+
+logger = logging.getLogger(__name__)
+
+
+class ReplayMessage(NamedTuple):
+    # Seconds to wait before sending this message at 1x speed
+    delay_s: float
+    message_str: str
+
+    icao: Optional[str]
+    # Whether this message should make its target alarming
+    alarming: bool
+
+
+def plan_replay(message_strs: List[str], settings: Settings, max_gap_s: float) -> List[ReplayMessage]:
+    """
+    Decode every captured message once before the replay starts to know its pacing and whether it should alarm
+    """
+    decoder = JsonTrafficDecoder()
+    ownship = settings.default_position
+
+    decoded = []
+    for message_str in message_strs:
+        try:
+            decoded.append(decoder.decode(message_str))
+        except (ValueError, KeyError, TypeError):
+            decoded.append(None)
+
+    valid = [m for m in decoded if m is not None]
+    geodesies = inverse_batch(ownship, (GPS(lat=m['Lat'], lng=m['Lng']) for m in valid))
+    # Built the way traffic service builds them, as if every message was received at 0
+    targets = [
+        build_traffic_info(m, received_ns=0, fix_ns=-int(m['Age'] * NS_PER_S), icao=str(m['Icao_addr']), geodesy=g)
+        for m, g in zip(valid, geodesies)
+    ]
+    # Replay situation reports ownship standing still
+    cpas = predict_cpa(targets, Velocity(track_dg=0, speed_kmh=0, vertical_speed_ms=0), settings.cpa_horizon_s, now_ns=0)
+    alarmings = iter(AlarmServiceWorker.is_alarming(t, cpa, settings) for t, cpa in zip(targets, cpas))
+
+    plan = []
+    previous_t = None
+
+    for message_str, message in zip(message_strs, decoded):
+        delay_s = 0.0
+        icao = None
+        alarming = False
+
+        if message is not None:
+            icao = str(message['Icao_addr'])
+            alarming = next(alarmings)
+
+            try:
+                t = parse_timestamp(message['Timestamp'])
+            except ValueError:
+                t = previous_t
+
+            if previous_t is not None and t is not None:
+                delay_s = min(max((t - previous_t).total_seconds(), 0.0), max_gap_s)
+            previous_t = t
+
+        plan.append(ReplayMessage(delay_s=delay_s, message_str=message_str, icao=icao, alarming=alarming))
+
+    return plan
+
+
+class ReplayHardwareStatus:
+    """
+    Stands in for HardwareStatusService, there is no battery to monitor in replay
+    """
+    battery_percent = 100.0
+    battery_minutes_remaining = None
+
+
+class AlarmLatencyProbe:
+    """
+    Tracks time between sending a message that makes a target alarming and alarm service reporting it
+    """
+
+    poll_interval = datetime.timedelta(milliseconds=5)
+
+    def __init__(self, alarm_service: AlarmServiceWorker):
+        self._alarm_service = alarm_service
+        self._due: Dict[str, float] = {}
+        self._alarmed = set()
+        self.latencies: List[float] = []
+        self._stop = Event()
+
+    def message_sent(self, message: ReplayMessage):
+        if message.alarming and message.icao not in self._alarmed and message.icao not in self._due:
+            self._due[message.icao] = time.perf_counter()
+
+    @property
+    def pending(self) -> int:
+        return len(self._due)
+
+    def run(self):
+        while not self._stop.wait(self.poll_interval.total_seconds()):
+            now = time.perf_counter()
+            alarmed = {t.icao for t in self._alarm_service.alarming_traffic()}
+            for icao in alarmed - self._alarmed:
+                due = self._due.pop(icao, None)
+                if due is not None:
+                    self.latencies.append(now - due)
+            self._alarmed = alarmed
+
+    def stop(self):
+        self._stop.set()
+
+
+class ReplayServer:
+    """
+    Serves replay plan over websocket and a fixed situation over http, both on localhost
+    """
+
+    def __init__(self, plan: List[ReplayMessage], speed: float, position: GPS, probe: AlarmLatencyProbe, clock: FakeClock):
+        self._plan = plan
+        self._speed = speed
+        self._probe = probe
+        self._clock = clock
+
+        self.started = Event()
+        self.finished = Event()
+        self.started_t = 0.0
+        self.finished_t = 0.0
+
+        self._ws_server = serve(self._handle_websocket, 'localhost', 0)
+        self.traffic_endpoint = f'ws://localhost:{self._ws_server.socket.getsockname()[1]}/traffic'
+
+        situation = json.dumps({
+            'GPSLatitude': position.lat,
+            'GPSLongitude': position.lng,
+            'GPSAltitudeMSL': 0,
+            'GPSHeightAboveEllipsoid': 0,
+            'GPSSatellites': 12,
+        }).encode()
+
+        class SituationHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(situation)))
+                self.end_headers()
+                self.wfile.write(situation)
+
+            def log_message(self, *args):
+                pass
+
+        self._http_server = ThreadingHTTPServer(('localhost', 0), SituationHandler)
+        self.situation_endpoint = f'http://localhost:{self._http_server.server_address[1]}/getSituation'
+
+    def _handle_websocket(self, websocket):
+        if self.started.is_set():
+            # Only first connection gets the replay, reconnects would skew the numbers
+            return
+
+        self.started_t = time.perf_counter()
+        self.started.set()
+
+        for message in self._plan:
+            if self._speed > 0 and message.delay_s > 0:
+                time.sleep(message.delay_s / self._speed)
+            self._clock.advance(message.delay_s)
+            self._probe.message_sent(message)
+            websocket.send(message.message_str)
+
+        self.finished_t = time.perf_counter()
+        self.finished.set()
+
+        # Keep connection open until client leaves
+        try:
+            for _ in websocket:
+                pass
+        except ConnectionClosed:
+            pass
+
+    def start(self):
+        Thread(target=self._ws_server.serve_forever, daemon=True).start()
+        Thread(target=self._http_server.serve_forever, daemon=True).start()
+
+    def shutdown(self):
+        self._ws_server.shutdown()
+        self._http_server.shutdown()
+
+
+def print_latencies(title: str, latencies: List[float], suffix: str = ''):
+    if not latencies:
+        print(f'{title}: no alarms raised{suffix}')
+        return
+
+    latencies = sorted(latencies)
+    print(f'{title}: n={len(latencies)} '
+          f'median={statistics.median(latencies) * 1000:.1f}ms '
+          f'p95={latencies[int(len(latencies) * 0.95)] * 1000:.1f}ms '
+          f'max={latencies[-1] * 1000:.1f}ms{suffix}')
+
+
+def print_histogram_latencies(title: str, histogram: Histogram):
+    """
+    Same as `print_latencies` for latencies recorded in nanoseconds, quantiles are upper bounds of histogram buckets
+    """
+    if not histogram.count:
+        print(f'{title}: no alarms raised')
+        return
+
+    h = histogram.snapshot()
+    print(f'{title}: n={h["count"]} median<={h["p50"] / 1_000_000:.1f}ms p95<={h["p95"] / 1_000_000:.1f}ms max={h["max"] / 1_000_000:.1f}ms')
+
+
+def print_histograms(workers):
+    """
+    Print stages every worker exports to metrics, durations in milliseconds
+    """
+    for worker in workers:
+        for name, histogram in worker.histograms().items():
+            if not histogram.count:
+                continue
+            h = histogram.snapshot()
+            if name.endswith('_ns'):
+                name, h = name[:-3], {k: h[k] / 1_000_000 for k in ('mean', 'p50', 'p95', 'max')}
+                unit = 'ms'
+            else:
+                unit = ''
+            print(f'  {worker.__class__.__name__}.{name}: n={histogram.count} '
+                  + ' '.join(f'{k}<={h[k]:.3g}{unit}' if k[0] == 'p' else f'{k}={h[k]:.3g}{unit}' for k in ('mean', 'p50', 'p95', 'max')))
+
+
+async def _run_async(workers):
+    await asyncio.gather(*(worker.run_async() for worker in workers))
+
+
+def replay(captures: List[Path], speed: float, position: GPS, max_gap_s: float, timeout_s: float, runtime: str):
+    message_strs = read_captures(captures)
+    if not message_strs:
+        raise SystemExit('No messages found in captures')
+
+    clock = FakeClock(start_ns=time.monotonic_ns())
+    previous_clock = set_clock(clock)
+
+    settings = Settings(default_position=position, mute=True)
+    settings_file = Path(tempfile.mkdtemp()) / 'settings.json'
+    settings_file.write_text(settings.json())
+    settings_service = SettingsService(settings_file=settings_file)
+
+    plan = plan_replay(message_strs, settings, max_gap_s)
+    print(f'Messages: {len(plan)}, alarming: {sum(m.alarming for m in plan)}, '
+          f'capture duration: {sum(m.delay_s for m in plan):.1f}s, speed: {f"{speed}x" if speed > 0 else "max"}, runtime: {runtime}')
+
+    # Services read endpoints from settings only when they run, so they can be created before servers are bound
+    sound_service = SoundServiceWorker(settings_service=settings_service)
+    position_service = PositionServiceWorker(settings_service=settings_service, sound_service=sound_service)
+    traffic_service = TrafficServiceWorker(settings_service=settings_service, position_service=position_service)
+    alarm_service = AlarmServiceWorker(
+        settings_service=settings_service,
+        traffic_service=traffic_service,
+        sound_service=sound_service,
+        hardware_status_service=ReplayHardwareStatus(),
+        position_service=position_service,
+    )
+
+    probe = AlarmLatencyProbe(alarm_service)
+    server = ReplayServer(plan, speed, position, probe, clock)
+    settings_service.set_settings(settings.copy(update={
+        'traffic_endpoint': server.traffic_endpoint,
+        'situation_endpoint': server.situation_endpoint,
+    }))
+
+    server.start()
+    workers = [position_service, traffic_service, alarm_service, sound_service]
+    if runtime == 'asyncio':
+        Thread(target=asyncio.run, args=(_run_async(workers),), daemon=True).start()
+    else:
+        for worker in workers:
+            Thread(target=worker.run, daemon=True).start()
+    Thread(target=probe.run, daemon=True).start()
+
+    deadline = time.perf_counter() + timeout_s
+    while time.perf_counter() < deadline:
+        if server.finished.is_set() and traffic_service.messages_seen >= len(plan):
+            break
+        time.sleep(0.01)
+    processed_t = time.perf_counter()
+
+    # Give alarm service one full period to notice the last alarming targets
+    alarm_deadline = min(deadline, processed_t + alarm_service.delay.total_seconds() + 1)
+    while probe.pending and time.perf_counter() < alarm_deadline:
+        time.sleep(0.01)
+
+    probe.stop()
+    for worker in workers:
+        worker.shutdown()
+    server.shutdown()
+    set_clock(previous_clock)
+
+    elapsed = processed_t - server.started_t if server.started.is_set() else 0.0
+    processed = traffic_service.messages_seen
+
+    print(f'Processed: {processed}/{len(plan)} messages in {elapsed:.2f}s, '
+          f'{processed / elapsed if elapsed else 0:.0f} msg/s')
+
+    print_latencies('Send to alarm latency', probe.latencies, f', missed={probe.pending}')
+    print_histogram_latencies('Receive to announce latency', alarm_service.announce_latencies)
+    print_histogram_latencies('Announce to speech latency', sound_service.speech_waits)
+
+    print('Stages:')
+    print_histograms(workers)
+
+    # ru_maxrss is in kilobytes on linux
+    print(f'Memory high-water mark: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB')
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m stratux_companion.replay')
+    parser.add_argument('captures', nargs='*', type=Path, default=[config.ROOT_DIR / 'traffic.jsonl'])
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay speed multiplier, 0 to replay as fast as possible')
+    parser.add_argument('--position', type=lambda s: GPS(*map(float, s.split(','))), default=Settings().default_position,
+                        help='Ownship position as lat,lng')
+    parser.add_argument('--max-gap', type=float, default=10.0, help='Longest pause between messages in capture time, seconds')
+    parser.add_argument('--timeout', type=float, default=600.0, help='Give up after this many seconds')
+    parser.add_argument('--runtime', choices=['threads', 'asyncio'], default='threads', help='How to run services')
+    parser.add_argument('--verbose', action='store_true', help='Log everything services do')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    replay(args.captures, args.speed, args.position, args.max_gap, args.timeout, args.runtime)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,8 @@
 import logging
+import os
 from pathlib import Path
-from threading import Lock
-from typing import Literal
+from threading import Lock, Condition, Thread
+from typing import Literal, Callable, List, Optional
 
 import pydantic
 
@@ -11,10 +12,21 @@ logger = logging.getLogger(__name__)
 
 
 class Settings(pydantic.BaseModel):
+    class Config:
+        # Settings are shared between threads, change them with SettingsService.set_settings
+        allow_mutation = False
+
+    # Run every service in its own thread, or all of them in one asyncio event loop
+    runtime: Literal['threads', 'asyncio'] = 'threads'
+
     traffic_endpoint: str = 'ws://192.168.10.1/traffic'
     situation_endpoint: str = 'http://192.168.10.1/getSituation'
+    situation_websocket_endpoint: str = 'ws://192.168.10.1/situation'
+    # Poll situation_endpoint, or stream situation_websocket_endpoint and poll only while it is not connected
+    situation_source: Literal['poll', 'websocket'] = 'poll'
 
     traffic_track_time_s: int = 30
+    traffic_capture_compression: Literal['none', 'gzip', 'zstd'] = 'none'
 
     mute: bool = False
 
@@ -26,10 +38,24 @@ class Settings(pydantic.BaseModel):
     max_distance_m: int = 10_000
     max_altitude_m: int = 3_000
 
+    # Traffic predicted to pass closer than cpa_distance_m within cpa_horizon_s seconds is alarming.
+    # Traffic within max_distance_m that is moving away and is further than cpa_distance_m is not.
+    cpa_distance_m: int = 1_500
+    cpa_horizon_s: int = 60
+
+    display_device: Literal['st7735', 'dummy', 'png'] = 'st7735'
     display_rotation: Literal[0, 1, 2, 3] = 0
     display_fps: int = 2
 
+    # Seconds between hardware sensor readings
+    hardware_sample_s: float = 2.0
+
+    # Seconds between metrics lines, and localhost port latest line is served on, 0 to not serve it
+    metrics_interval_s: float = 10.0
+    metrics_port: int = 8091
+
     battery_cells: int = 4
+    battery_capacity_mah: int = 5_000
     battery_alarm_p: int = 30
 
 
@@ -38,15 +64,60 @@ class Settings_Local(Settings):
 
 
 class SettingsService:
+    """
+    Settings service holds current settings. Settings are immutable, so readers can keep the instance they got.
+
+    Subscribers are told about every change, so workers can derive what they need from settings once per change
+    instead of on every use. Settings are persisted by a background thread, written to a temporary file
+    that replaces settings file only once it is complete.
+    """
+
     def __init__(self, settings_file: Path):
         self._settings_file = settings_file
-        self._settings = self._load_settings()
         self._lock = Lock()
+        self._subscribers: List[Callable[[Settings], None]] = []
+
+        # Latest settings not persisted yet
+        self._unpersisted: Optional[Settings] = None
+        self._persist_condition = Condition()
+        self._persist_thread: Optional[Thread] = None
+
+        self._settings = self._load_settings()
 
         logger.debug(f'Initialized settings at {settings_file}: {self._settings}')
 
-    def _persist_settings(self):
-        self._settings_file.write_text(self._settings.json())
+    def _persist_settings(self, settings: Settings):
+        tmp_file = self._settings_file.with_name(f'{self._settings_file.name}.tmp')
+        with tmp_file.open('w') as f:
+            f.write(settings.json())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self._settings_file)
+
+    def _persist_in_background(self):
+        while True:
+            with self._persist_condition:
+                while self._unpersisted is None:
+                    self._persist_condition.wait()
+                settings = self._unpersisted
+
+            try:
+                self._persist_settings(settings)
+            except Exception:
+                logger.exception(f'Error while writing settings to {self._settings_file}')
+
+            with self._persist_condition:
+                # Settings could have been changed again while writing
+                if self._unpersisted is settings:
+                    self._unpersisted = None
+                self._persist_condition.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until latest settings are persisted. Return False on timeout.
+        """
+        with self._persist_condition:
+            return self._persist_condition.wait_for(lambda: self._unpersisted is None, timeout)
 
     def _load_settings(self) -> Settings:
         try:
@@ -56,14 +127,77 @@ class SettingsService:
             return self._reset_settings()
 
     def _reset_settings(self) -> Settings:
-        self._settings = Settings()
-        self._persist_settings()
-        return self._settings
+        settings = Settings()
+        self._persist_settings(settings)
+        return settings
+
+    @property
+    def settings_file(self) -> Path:
+        return self._settings_file
 
     def get_settings(self) -> Settings:
         return self._settings
 
     def set_settings(self, settings: Settings):
+        """
+        Replace current settings, notify subscribers and persist settings in background
+        """
+        with self._lock:
+            self._settings = settings
+            subscribers = self._subscribers[:]
+
+            with self._persist_condition:
+                self._unpersisted = settings
+                if self._persist_thread is None:
+                    self._persist_thread = Thread(target=self._persist_in_background, name='settings', daemon=True)
+                    self._persist_thread.start()
+                self._persist_condition.notify_all()
+
+        self._notify(subscribers, settings)
+
+    def reload_settings(self) -> bool:
+        """
+        Read settings file again and publish its settings if they differ from current ones. Return True if they did.
+
+        Settings file that is not valid is left alone and current settings are kept, so it can be fixed and saved again.
+        Settings file written by this service holds current settings, so it is not reloaded.
+        """
+        try:
+            settings = Settings.parse_file(self._settings_file)
+        except Exception as e:
+            logger.error(f'Keeping current settings, error while reading settings from {self._settings_file}: {e}')
+            return False
+
         with self._lock:
-            self._persist_settings()
+            with self._persist_condition:
+                # Settings file is about to be overwritten with newer settings anyway
+                if self._unpersisted is not None:
+                    return False
+
+            if settings == self._settings:
+                return False
+
+            logger.info(f'Reloaded settings from {self._settings_file}: {settings}')
             self._settings = settings
+            subscribers = self._subscribers[:]
+
+        self._notify(subscribers, settings)
+        return True
+
+    @staticmethod
+    def _notify(subscribers: List[Callable[[Settings], None]], settings: Settings):
+        for callback in subscribers:
+            try:
+                callback(settings)
+            except Exception:
+                logger.exception(f'Error in settings subscriber {callback}')
+
+    def subscribe(self, callback: Callable[[Settings], None]):
+        """
+        Call `callback` with current settings right away, and with new settings every time they change.
+        It is called from the thread that changed settings.
+        """
+        with self._lock:
+            self._subscribers.append(callback)
+            settings = self._settings
+        callback(settings)
@@ -0,0 +1,169 @@
+import asyncio
+import ctypes
+import ctypes.util
+import datetime
+import logging
+import os
+import select
+import struct
+from typing import Optional, Tuple
+
+from stratux_companion.settings_service import SettingsService
+from stratux_companion.util import ServiceWorker
+
+logger = logging.getLogger(__name__)
+
+
+# inotify(7) event mask bits and event header layout
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class _Inotify:
+    """
+    Minimal inotify binding through libc, watching a directory for files written or moved into it
+    """
+
+    def __init__(self, directory: str):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), _IN_CLOSE_WRITE | _IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f'inotify_add_watch failed for {directory}')
+
+    def read_names(self) -> Tuple[str, ...]:
+        """
+        Return names of files that changed since last read, without blocking
+        """
+        names = []
+        while True:
+            try:
+                buffer = os.read(self.fd, 4096)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(buffer):
+                _, _, _, length = _INOTIFY_EVENT.unpack_from(buffer, offset)
+                offset += _INOTIFY_EVENT.size
+                names.append(os.fsdecode(buffer[offset:offset + length].rstrip(b'\0')))
+                offset += length
+
+        return tuple(names)
+
+
+class SettingsWatcherWorker(ServiceWorker):
+    """
+    Settings watcher reloads settings file when it is changed, so running services pick up new settings without restart.
+
+    On Linux it sleeps on inotify until a file in settings directory is written or replaced,
+    or until `wake()` writes to its self-pipe, so shutdown does not wait for `idle_timeout`.
+    Elsewhere settings file is polled every `poll_delay`, comparing stat only.
+    Settings service ignores files holding current settings, so its own writes do not cause a reload.
+
+    Services read `runtime`, `display_device`, `display_rotation`, battery and capture settings only at start,
+    those still need a restart.
+    """
+
+    # How long to wait for inotify events before updating heartbeat
+    idle_timeout = datetime.timedelta(seconds=60)
+
+    # Stat polling interval when inotify is not available
+    poll_delay = datetime.timedelta(seconds=2)
+
+    def __init__(self, settings_service: SettingsService):
+        self._settings_service = settings_service
+        self._settings_file = settings_service.settings_file
+
+        self._inotify: Optional[_Inotify] = None
+        # Self-pipe waking up select, written by wake()
+        self._wake_fds: Optional[Tuple[int, int]] = None
+        try:
+            inotify = _Inotify(str(self._settings_file.parent))
+            self._wake_fds = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+            self._inotify = inotify
+            self.delay = datetime.timedelta(seconds=0)
+            logger.debug(f'Watching {self._settings_file} with inotify')
+        except (OSError, AttributeError) as e:
+            self.delay = self.poll_delay
+            logger.debug(f'inotify is not available ({e}), polling {self._settings_file}')
+
+        self._stat = self._stat_settings_file()
+
+        super().__init__()
+
+    def trigger(self):
+        if self._inotify is None:
+            self._poll()
+            return
+
+        wake_fd = self._wake_fds[0]
+        readable, _, _ = select.select([self._inotify.fd, wake_fd], [], [], self.idle_timeout.total_seconds())
+        if wake_fd in readable:
+            self._drain_wake()
+        if self._inotify.fd in readable:
+            self._on_events()
+
+    async def trigger_async(self):
+        if self._inotify is None:
+            self._poll()
+            return
+
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        wake_fd = self._wake_fds[0]
+        for fd in (self._inotify.fd, wake_fd):
+            loop.add_reader(fd, lambda fd=fd: readable.done() or readable.set_result(fd))
+        try:
+            fd = await asyncio.wait_for(readable, self.idle_timeout.total_seconds())
+        except asyncio.TimeoutError:
+            return
+        finally:
+            loop.remove_reader(self._inotify.fd)
+            loop.remove_reader(wake_fd)
+
+        if fd == wake_fd:
+            self._drain_wake()
+        # inotify events arriving with a wake up are picked up here, or on next trigger
+        self._on_events()
+
+    def wake(self):
+        super().wake()
+        if self._wake_fds is not None:
+            try:
+                os.write(self._wake_fds[1], b'\0')
+            except BlockingIOError:
+                # Pipe is full, select is woken up already
+                pass
+
+    def _drain_wake(self):
+        try:
+            while os.read(self._wake_fds[0], 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _on_events(self):
+        if self._settings_file.name in self._inotify.read_names():
+            self._settings_service.reload_settings()
+
+    def _poll(self):
+        stat = self._stat_settings_file()
+        if stat != self._stat:
+            self._stat = stat
+            if stat is not None:
+                self._settings_service.reload_settings()
+
+    def _stat_settings_file(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            stat = os.stat(self._settings_file)
+        except FileNotFoundError:
+            return None
+        # Settings file is replaced on save, so inode changes even when mtime resolution is coarse
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
@@ -1,24 +1,26 @@
+import asyncio
 import datetime
+import hashlib
 import logging
-from enum import Enum
+import threading
+import time
+import wave
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum, IntEnum
+from pathlib import Path
 from queue import Queue
+from typing import Dict, NamedTuple, Optional, Deque, Iterable, List
 
 import chime
 import pyttsx3
 
-from stratux_companion.settings_service import SettingsService
-from stratux_companion.util import ServiceWorker
+from stratux_companion.settings_service import SettingsService, Settings
+from stratux_companion.util import ServiceWorker, Histogram, DEPTH_BOUNDS, NS_PER_S
 
 logger = logging.getLogger(__name__)
 
 
-# TODO:
-#  - message deduplication
-#  - system messages queue, high priority
-#  - traffic messages queue, low priority
-
-
-
 class Beeps(Enum):
     #warning = 'warning'
     success = 'success'
@@ -26,43 +28,259 @@ class Beeps(Enum):
     info = 'info'
 
 
+class SpeechPriority(IntEnum):
+    """
+    Queued speech with lower priority value is spoken first
+    """
+    system = 0
+    traffic = 1
+
+
+class Speech(NamedTuple):
+    priority: SpeechPriority
+    # Order of queueing, speech of the same priority is spoken in this order
+    seq: int
+    # time.monotonic() when text was queued, or last replaced. Real time even when util clock is replaced by replay.
+    queued_t: float
+    text: str
+
+
+class PhraseCache:
+    """
+    Phrase cache keeps speech rendered by TTS engine on disk, so every phrase fragment is synthesized once.
+
+    Phrases are split into fragments on commas. Alarms are made of a few fragments with quantized numbers,
+    so after a while they are assembled from cached fragments without running TTS at all.
+    """
+
+    # Pause between fragments of a phrase, where the comma was
+    pause = datetime.timedelta(milliseconds=150)
+
+    def __init__(self, directory: Path):
+        self._directory = directory
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._phrase_file = directory / 'phrase.wav'
+
+    @staticmethod
+    def fragments(text: str) -> List[str]:
+        return [f.strip() for f in text.split(',') if f.strip()]
+
+    def is_cached(self, fragment: str) -> bool:
+        return self._fragment_file(fragment).exists()
+
+    def render(self, engine, fragment: str) -> Path:
+        """
+        Return wav file with `fragment` spoken, synthesizing it if it is not cached yet
+        """
+        path = self._fragment_file(fragment)
+        if not path.exists():
+            tmp_path = path.with_name(f'{path.stem}.tmp.wav')
+            engine.save_to_file(fragment, str(tmp_path))
+            engine.runAndWait()
+            tmp_path.rename(path)
+        return path
+
+    def get(self, engine, text: str) -> Path:
+        """
+        Return wav file with whole `text` spoken, assembled from its fragments
+        """
+        paths = [self.render(engine, fragment) for fragment in self.fragments(text)]
+        if len(paths) == 1:
+            return paths[0]
+
+        with wave.open(str(paths[0]), 'rb') as first:
+            params = first.getparams()
+
+        silence = b'\0' * (int(params.framerate * self.pause.total_seconds()) * params.sampwidth * params.nchannels)
+
+        with wave.open(str(self._phrase_file), 'wb') as phrase:
+            phrase.setparams(params)
+            for i, path in enumerate(paths):
+                if i:
+                    phrase.writeframes(silence)
+                with wave.open(str(path), 'rb') as fragment:
+                    phrase.writeframes(fragment.readframes(fragment.getnframes()))
+
+        return self._phrase_file
+
+    def _fragment_file(self, fragment: str) -> Path:
+        return self._directory / f'{hashlib.sha1(fragment.encode()).hexdigest()[:16]}.wav'
+
+
 class SoundServiceWorker(ServiceWorker):
     """
-    Sound service interfaces with sound system and converts text messages into sound messages
+    Sound service interfaces with sound system and converts text messages into sound messages.
+    Worker is woken up when something is queued, so it does not have to poll.
+
+    Speech is queued by priority, and text queued with the key of a still queued one replaces it in its place in line,
+    so repeated announcements of the same target do not pile up. TTS engine is initialized once and used from worker thread only.
+    With `speech_cache_dir`, spoken phrases are played from PhraseCache, and fragments given to `prerender`
+    are synthesized while there is nothing to say.
     """
 
-    delay = datetime.timedelta(seconds=0.5)
+    delay = datetime.timedelta(seconds=5)
+
+    # Speech queued longer than that ago is no longer relevant
+    speech_timeout = datetime.timedelta(seconds=5)
 
-    def __init__(self, settings_service: SettingsService):
+    def __init__(self, settings_service: SettingsService, speech_cache_dir: Optional[Path] = None):
         self._settings_service = settings_service
-        self._queue = Queue()
         self._beep_queue = Queue()
 
+        # key -> queued speech
+        self._speech: Dict[str, Speech] = {}
+        self._speech_seq = 0
+        self._speech_lock = threading.Lock()
+
+        # Speech queued, including the new one, every time speech is queued. Nanoseconds speech waited to be spoken.
+        self.queue_depths = Histogram(DEPTH_BOUNDS)
+        self.speech_waits = Histogram()
+
+        self._engine = None
+        self._engine_failed = False
+        self._phrase_cache = PhraseCache(speech_cache_dir) if speech_cache_dir is not None else None
+        self._prerender: Deque[str] = deque()
+
+        # TTS engine has to be used from the thread that created it, also in asyncio runtime
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sound')
+
         chime.theme('chime')
 
-        self.play_beep(Beeps.success)
+        self._mute = False
+        settings_service.subscribe(self._on_settings)
 
         super().__init__()
 
+        self.play_beep(Beeps.success)
+
+    def _on_settings(self, settings: Settings):
+        self._mute = settings.mute
+
+    def histograms(self) -> Dict[str, Histogram]:
+        return {
+            **super().histograms(),
+            'queue_depth': self.queue_depths,
+            'speech_wait_ns': self.speech_waits,
+        }
+
     def trigger(self):
-        if not self._queue.empty():
-            ts, text = self._queue.get_nowait()
-            if (datetime.datetime.utcnow() - ts) > datetime.timedelta(seconds=5):
-                return
-            self._play_sound(text)
+        self._play_beeps()
 
-        if not self._beep_queue.empty():
-            beep = self._beep_queue.get_nowait()
-            logger.debug(f'Playing beep: {beep}')
-            getattr(chime, beep.value)()
+        while True:
+            speech = self._pop_speech()
+            if speech is None:
+                break
+
+            waited_t = time.monotonic() - speech.queued_t
+            if waited_t > self.speech_timeout.total_seconds():
+                logger.debug(f'Dropping outdated speech: {speech.text}')
+                continue
 
-    def play_sound(self, text: str):
-        self._queue.put_nowait((datetime.datetime.utcnow(), text))
+            self.speech_waits.record(int(waited_t * NS_PER_S))
+            self._play_sound(speech.text)
+            self._play_beeps()
+
+        self._prerender_next()
+
+    async def trigger_async(self):
+        await asyncio.get_running_loop().run_in_executor(self._executor, self.trigger)
+
+    def play_sound(self, text: str, priority: SpeechPriority = SpeechPriority.system, key: Optional[str] = None):
+        """
+        Queue `text` to be spoken. If speech with the same `key` (`text` by default) is still queued, it is replaced.
+        """
+        key = text if key is None else key
+
+        with self._speech_lock:
+            queued = self._speech.get(key)
+            if queued is not None and queued.priority == priority:
+                seq = queued.seq
+            else:
+                seq = self._speech_seq = self._speech_seq + 1
+            self._speech[key] = Speech(priority=priority, seq=seq, queued_t=time.monotonic(), text=text)
+            self.queue_depths.record(len(self._speech))
+
+        self.wake()
+
+    def _pop_speech(self) -> Optional[Speech]:
+        with self._speech_lock:
+            if not self._speech:
+                return None
+            key = min(self._speech, key=lambda k: (self._speech[k].priority, self._speech[k].seq))
+            return self._speech.pop(key)
+
+    def _get_engine(self):
+        if self._engine is None and not self._engine_failed:
+            try:
+                self._engine = pyttsx3.init()
+            except Exception:
+                logger.exception('Error initializing TTS engine, speech is disabled')
+                self._engine_failed = True
+        return self._engine
 
     def _play_sound(self, text: str):
         logger.debug(f'Speech text: {text}')
-        if not self._settings_service.get_settings().mute:
-            pyttsx3.speak(text)
+        if self._mute:
+            return
+
+        engine = self._get_engine()
+        if engine is None:
+            return
+
+        if self._phrase_cache is not None:
+            try:
+                chime.play_wav(self._phrase_cache.get(engine, text))
+                return
+            except Exception:
+                logger.exception('Error playing cached speech, speaking it directly')
+
+        engine.say(text)
+        engine.runAndWait()
+
+    def prerender(self, fragments: Iterable[str]):
+        """
+        Synthesize phrase fragments into phrase cache while there is nothing to say
+        """
+        if self._phrase_cache is None:
+            return
+
+        self._prerender.extend(fragments)
+        self.wake()
+
+    def _prerender_next(self):
+        """
+        Synthesize one fragment that is not cached yet, so queued speech waits for one fragment at most
+        """
+        if self._mute:
+            return
+
+        while self._prerender:
+            fragment = self._prerender.popleft()
+            if self._phrase_cache.is_cached(fragment):
+                continue
+
+            engine = self._get_engine()
+            if engine is None:
+                self._prerender.clear()
+                return
+
+            try:
+                self._phrase_cache.render(engine, fragment)
+            except Exception:
+                logger.exception(f'Error rendering speech fragment: {fragment}')
+                self._prerender.clear()
+                return
+
+            if self._prerender:
+                self.wake()
+            return
 
     def play_beep(self, beep: Beeps):
         self._beep_queue.put_nowait(beep)
+        self.wake()
+
+    def _play_beeps(self):
+        while not self._beep_queue.empty():
+            beep = self._beep_queue.get_nowait()
+            logger.debug(f'Playing beep: {beep}')
+            getattr(chime, beep.value)()
@@ -0,0 +1,147 @@
+import abc
+import json
+import logging
+from typing import Optional, Tuple
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+# Fields of stratux TrafficInfo message that are actually used by TrafficServiceWorker
+TRAFFIC_FIELDS: Tuple[str, ...] = (
+    'Icao_addr',
+    'Reg',
+    'Tail',
+    'Position_valid',
+    'Lat',
+    'Lng',
+    'Alt',
+    'Speed',
+    'Speed_valid',
+    'Track',
+    'Vvel',
+    'Timestamp',
+    'Age',
+    'AgeExtrapolation',
+    'ExtrapolatedPosition',
+)
+
+# Stratux encodes messages with go encoding/json, which never puts whitespace between key and value
+_INVALID_POSITION_MARKER = '"Position_valid":false'
+
+
+class TrafficDecoder(metaclass=abc.ABCMeta):
+    """
+    Traffic decoder converts raw stratux /traffic message into a dict holding only `TRAFFIC_FIELDS`.
+    Messages with invalid position are rejected before being parsed.
+    """
+    name: str
+
+    def decode(self, message_str: str) -> Optional[dict]:
+        """
+        Return projected message, or None if message does not have a valid position
+        """
+        if _INVALID_POSITION_MARKER in message_str:
+            return None
+
+        message = self._decode(message_str)
+
+        if not message['Position_valid']:
+            return None
+
+        return message
+
+    @abc.abstractmethod
+    def _decode(self, message_str: str) -> dict:
+        raise NotImplementedError()
+
+
+class JsonTrafficDecoder(TrafficDecoder):
+    """
+    Stdlib json decoder, always available
+    """
+    name = 'json'
+
+    def _decode(self, message_str: str) -> dict:
+        message = json.loads(message_str)
+        return {field: message[field] for field in TRAFFIC_FIELDS}
+
+
+class OrjsonTrafficDecoder(TrafficDecoder):
+    """
+    orjson decoder, used when orjson is installed
+    """
+    name = 'orjson'
+
+    def _decode(self, message_str: str) -> dict:
+        message = orjson.loads(message_str)
+        return {field: message[field] for field in TRAFFIC_FIELDS}
+
+
+if msgspec is not None:
+    class _TrafficMessage(msgspec.Struct):
+        """
+        Only declared fields are decoded by msgspec, the rest of the message is skipped without building objects.
+        """
+        Icao_addr: int
+        Reg: str
+        Tail: str
+        Position_valid: bool
+        Lat: float
+        Lng: float
+        Alt: int
+        Speed: int
+        Speed_valid: bool
+        Track: float
+        Vvel: int
+        Timestamp: str
+        Age: float
+        AgeExtrapolation: float
+        ExtrapolatedPosition: bool
+
+
+class MsgspecTrafficDecoder(TrafficDecoder):
+    """
+    msgspec decoder, used when msgspec is installed. Decodes `TRAFFIC_FIELDS` only.
+    """
+    name = 'msgspec'
+
+    def __init__(self):
+        self._decoder = msgspec.json.Decoder(type=_TrafficMessage)
+
+    def _decode(self, message_str: str) -> dict:
+        return msgspec.structs.asdict(self._decoder.decode(message_str))
+
+
+def available_decoders() -> Tuple[TrafficDecoder, ...]:
+    """
+    Return instances of all decoders usable in current environment, fastest first
+    """
+    decoders = []
+
+    if msgspec is not None:
+        decoders.append(MsgspecTrafficDecoder())
+    if orjson is not None:
+        decoders.append(OrjsonTrafficDecoder())
+
+    decoders.append(JsonTrafficDecoder())
+
+    return tuple(decoders)
+
+
+def get_traffic_decoder() -> TrafficDecoder:
+    """
+    Return fastest decoder available
+    """
+    decoder = available_decoders()[0]
+    logger.debug(f'Using {decoder.name} traffic decoder')
+    return decoder
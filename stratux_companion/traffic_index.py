@@ -0,0 +1,107 @@
+import heapq
+from bisect import insort, bisect_left
+from typing import Dict, List, Tuple, Optional, Iterator, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from stratux_companion.traffic_service import TrafficInfo
+
+
+class TrafficIndex:
+    """
+    Traffic index keeps tracked traffic ordered by distance, so snapshots of nearest traffic don't have to sort whole traffic state.
+    It also keeps a heap of position fix times, so expired traffic is found without looking at fresh one,
+    whatever order fixes arrive in. Heap entries of replaced and removed traffic are dropped once they reach the top.
+
+    Index is not thread safe, caller is responsible for locking.
+    """
+
+    def __init__(self):
+        self._by_icao: Dict[str, 'TrafficInfo'] = {}
+
+        # Heap of (fix_ns, icao), may hold outdated entries of traffic that was updated or removed since
+        self._by_fix: List[Tuple[int, str]] = []
+
+        # Sorted list of (distance_m, icao)
+        self._by_distance: List[Tuple[int, str]] = []
+
+    def __len__(self) -> int:
+        return len(self._by_icao)
+
+    def __iter__(self) -> Iterator['TrafficInfo']:
+        return iter(self._by_icao.values())
+
+    def get(self, icao: str) -> Optional['TrafficInfo']:
+        return self._by_icao.get(icao)
+
+    def update(self, traffic_info: 'TrafficInfo'):
+        """
+        Insert new or replace existing traffic info
+        """
+        previous = self._by_icao.get(traffic_info.icao)
+        if previous is not None and previous.fix_ns == traffic_info.fix_ns:
+            # Same fix, so its heap entry still holds
+            self._unlink(previous)
+        else:
+            self.remove(traffic_info.icao)
+            self._push_fix(traffic_info)
+
+        self._by_icao[traffic_info.icao] = traffic_info
+        insort(self._by_distance, (traffic_info.distance_m, traffic_info.icao))
+
+    def replace_all(self, traffic_infos: List['TrafficInfo']):
+        """
+        Replace every tracked traffic info at once with infos of the same traffic and fixes, for example with new distances.
+        Cheaper than updating them one by one, since distance order is sorted only once.
+        """
+        self._by_icao = {t.icao: t for t in traffic_infos}
+        self._by_distance = sorted((t.distance_m, t.icao) for t in traffic_infos)
+
+    def remove(self, icao: str) -> Optional['TrafficInfo']:
+        """
+        Remove traffic info from index, return it if it was present
+        """
+        traffic_info = self._by_icao.pop(icao, None)
+        if traffic_info is None:
+            return None
+
+        self._unlink(traffic_info)
+        return traffic_info
+
+    def _unlink(self, traffic_info: 'TrafficInfo'):
+        """
+        Remove traffic info from distance index
+        """
+        key = (traffic_info.distance_m, traffic_info.icao)
+        i = bisect_left(self._by_distance, key)
+        del self._by_distance[i]
+
+    def _push_fix(self, traffic_info: 'TrafficInfo'):
+        heapq.heappush(self._by_fix, (traffic_info.fix_ns, traffic_info.icao))
+
+        # Targets that keep reporting leave outdated entries behind faster than they expire
+        if len(self._by_fix) > 4 * len(self._by_icao) + 64:
+            self._by_fix = [(t.fix_ns, t.icao) for t in self._by_icao.values()]
+            self._by_fix.append((traffic_info.fix_ns, traffic_info.icao))
+            heapq.heapify(self._by_fix)
+
+    def evict_older_than(self, fix_ns: int) -> List['TrafficInfo']:
+        """
+        Remove and return traffic infos with last position fix before `fix_ns`.
+        Costs only the number of expired heap entries.
+        """
+        evicted = []
+
+        while self._by_fix and self._by_fix[0][0] < fix_ns:
+            entry_fix_ns, icao = heapq.heappop(self._by_fix)
+            traffic_info = self._by_icao.get(icao)
+            if traffic_info is not None and traffic_info.fix_ns == entry_fix_ns:
+                evicted.append(self.remove(icao))
+
+        return evicted
+
+    def closest(self, limit: Optional[int] = None) -> List['TrafficInfo']:
+        """
+        Return up to `limit` traffic infos, nearest first
+        """
+        entries = self._by_distance if limit is None else self._by_distance[:limit]
+        return [self._by_icao[icao] for _, icao in entries]
@@ -1,17 +1,26 @@
+import asyncio
 import datetime
-import json
 import logging
-from collections import OrderedDict
-from threading import Lock
-from typing import NamedTuple, List, Dict
+import sys
+import time
+from typing import NamedTuple, List, Dict, Optional, Tuple, Callable
 
 from geopy.units import meters
 from websockets import ConnectionClosed
 from websockets.sync.client import connect
 
+try:
+    from websockets.asyncio.client import connect as connect_async
+except ImportError:
+    # websockets < 13
+    from websockets.client import connect as connect_async
+
+from stratux_companion.capture_service import CaptureServiceWorker
 from stratux_companion.position_service import PositionServiceWorker
-from stratux_companion.settings_service import SettingsService
-from stratux_companion.util import GPS, ServiceWorker, km_h
+from stratux_companion.settings_service import SettingsService, Settings
+from stratux_companion.traffic_decoder import get_traffic_decoder
+from stratux_companion.traffic_index import TrafficIndex
+from stratux_companion.util import GPS, ServiceWorker, km_h, Geodesy, inverse_batch, monotonic_ns, NS_PER_S, Histogram, DEPTH_BOUNDS
 
 """
 {"Icao_addr":11030261,"Reg":"N6340E","Tail":"N6340E","Emitter_category":1,"SurfaceVehicleType":0,"OnGround":false,"Addr_type":0,"TargetType":1,"SignalLevel":-28.873949984654253,"SignalLevelHist":null,"Squawk":3655,"Position_valid":true,"Lat":30.346046,"Lng":-97.770645,"Alt":4300,"GnssDiffFromBaroAlt":75,"AltIsGNSS":false,"NIC":8,"NACp":9,"Track":198,"TurnRate":0,"Speed":99,"Speed_valid":true,"Vvel":0,"Timestamp":"2024-01-12T05:30:20.777200261Z","PriorityStatus":0,"Age":59.72,"AgeLastAlt":59.72,"Last_seen":"0001-01-01T00:20:29.26Z","Last_alt":"0001-01-01T00:20:29.26Z","Last_GnssDiff":"0001-01-01T00:20:29.26Z","Last_GnssDiffAlt":4300,"Last_speed":"0001-01-01T00:20:29.26Z","Last_source":2,"ExtrapolatedPosition":true,"Last_extrapolation":"0001-01-01T00:21:28.75Z","AgeExtrapolation":0.23,"Lat_fix":30.372026,"Lng_fix":-97.76068,"Alt_fix":4300,"BearingDist_valid":false,"Bearing":0,"Distance":0,"DistanceEstimated":0,"DistanceEstimatedLastTs":"0001-01-01T00:00:00Z","ReceivedMsgs":261,"IsStratux":false}
@@ -77,7 +86,6 @@ from stratux_companion.util import GPS, ServiceWorker, km_h
 
 
 logger = logging.getLogger(__name__)
-traffic_messages_logger = logging.getLogger('stratux_companion.traffic')
 
 
 class TrafficInfo(NamedTuple):
@@ -87,7 +95,15 @@ class TrafficInfo(NamedTuple):
     Reference:
     - main/traffic.go
     """
-    timestamp: datetime.datetime
+    # util.monotonic_ns() when message was received
+    received_ns: int
+    # util.monotonic_ns() of last position fix stratux got from the target,
+    # and of the moment reported position is for, which is later than the fix while stratux extrapolates it
+    fix_ns: int
+    position_ns: int
+    extrapolated: bool
+    # Stratux timestamp of the message. Stays the same when stratux re-sends target without hearing from it.
+    message_timestamp: str
 
     gps: GPS
 
@@ -97,12 +113,107 @@ class TrafficInfo(NamedTuple):
     distance_m: int
     speed_kmh: int
     bearing_absolude_dg: int
+    track_dg: int
+    vertical_speed_ms: float
+    # Stratux has speed and track of the target. Without them its motion is unknown, speed and track are 0.
+    speed_valid: bool
 
     icao: str
     registration: str
     tail: str
 
 
+class TrafficSnapshot(NamedTuple):
+    """
+    Immutable view of tracked traffic, published by TrafficServiceWorker after every update.
+    Readers may hold on to it as long as they like. Readers that need to know what changed subscribe to TrafficUpdate.
+    """
+    messages_seen: int
+
+    # Nearest first
+    traffic: Tuple[TrafficInfo, ...]
+
+    def closest(self, limit: Optional[int] = None) -> List[TrafficInfo]:
+        return list(self.traffic if limit is None else self.traffic[:limit])
+
+
+class TrafficUpdate(NamedTuple):
+    """
+    Published to TrafficServiceWorker subscribers every time traffic state changes
+    """
+    snapshot: TrafficSnapshot
+
+    # Traffic that got new messages and traffic that is no longer tracked
+    updated: Tuple[TrafficInfo, ...]
+    evicted: Tuple[TrafficInfo, ...]
+
+    # time.monotonic() when messages behind `updated` were received
+    received_t: float
+
+
+def relative_geometry(geodesy: Geodesy) -> Tuple[int, int]:
+    """
+    Return distance and bearing as stored in traffic info
+    """
+    distance_m = int(geodesy.distance_m)
+    # It is unlikely we receive a message from that far
+    if distance_m > 50_000:
+        distance_m = 0
+
+    return distance_m, int(geodesy.bearing_dg)
+
+
+def build_traffic_info(message: dict, received_ns: int, fix_ns: int, icao: str, geodesy: Optional[Geodesy], previous: Optional[TrafficInfo] = None) -> TrafficInfo:
+    """
+    Build traffic info from decoded message and geodesy from ownship to the target. Values that did not change since `previous`
+    are shared with it instead of being allocated again, `geodesy` is None when target did not move since `previous`.
+    """
+    extrapolated = message['ExtrapolatedPosition']
+    if extrapolated:
+        position_ns = received_ns - int(message['AgeExtrapolation'] * NS_PER_S)
+    else:
+        position_ns = fix_ns
+
+    if geodesy is None:
+        gps = previous.gps
+        distance_m, bearing_dg = previous.distance_m, previous.bearing_absolude_dg
+    else:
+        gps = GPS(lat=message['Lat'], lng=message['Lng'])
+        distance_m, bearing_dg = relative_geometry(geodesy)
+
+    registration, tail = message['Reg'], message['Tail']
+    if previous is not None and previous.registration == registration and previous.tail == tail:
+        registration, tail = previous.registration, previous.tail
+    else:
+        registration, tail = sys.intern(str(registration)), sys.intern(str(tail))
+
+    altitude_m = int(meters(feet=message['Alt']))
+    # Service ceiling usually is at 12 000, so anything larger than that is wonky
+    if altitude_m > 15_000:
+        altitude_m = 0
+
+    speed_valid = message['Speed_valid']
+
+    return TrafficInfo(
+        received_ns,
+        fix_ns,
+        position_ns,
+        extrapolated,
+        message['Timestamp'],
+        gps,
+        altitude_m,
+        distance_m,
+        km_h(message['Speed'] if speed_valid else 0),
+        bearing_dg,
+        int(message['Track']) if speed_valid else 0,
+        meters(feet=message['Vvel']) / 60,
+        speed_valid,
+        icao,
+        registration,
+        tail,
+    )
+
+
 class TrafficServiceWorker(ServiceWorker):
     """
     Traffic service interfaces with stratux and maintains a buffer of most recent traffic messages received.
@@ -113,43 +224,101 @@ class TrafficServiceWorker(ServiceWorker):
     # Timeout for reading messages from websocket
     message_timeout = datetime.timedelta(seconds=5)
 
-    def __init__(self, settings_service: SettingsService, position_service: PositionServiceWorker):
+    # Max number of already received messages to be processed together
+    batch_size = 64
+
+    # Distances to all tracked traffic are recomputed once ownship moves that far from where they were computed
+    ownship_moved_m = 50
+
+    def __init__(self, settings_service: SettingsService, position_service: PositionServiceWorker, capture_service: Optional[CaptureServiceWorker] = None):
         self._settings_service = settings_service
         self._position_service = position_service
+        self._capture_service = capture_service
 
-        self._traffic_info_buffer: OrderedDict[str, TrafficInfo] = OrderedDict()
+        # Traffic index is only touched by websocket consumer, readers get snapshots
+        self._traffic_index = TrafficIndex()
+        self._snapshot = TrafficSnapshot(messages_seen=0, traffic=())
+        # Ownship position distances and bearings in traffic index are relative to
+        self._geometry_position: Optional[GPS] = None
 
-        self._lock = Lock()
+        self.messages_seen = 0
+        # Messages skipped because stratux re-sent a target without new data, or its position fix was too old
+        self.messages_resent = 0
+        self.messages_outdated = 0
 
-        self._traffic_state: Dict[str, TrafficInfo] = {}
+        # Stratux icao address -> its string, for tracked traffic only
+        self._icao_names: Dict[int, str] = {}
 
-        self.messages_seen = 0
+        self._decoder = get_traffic_decoder()
+
+        # Nanoseconds spent decoding every message, solving geodesy for a batch and processing a whole batch
+        self.parse_durations = Histogram()
+        self.geodesy_durations = Histogram()
+        self.batch_durations = Histogram()
+        self.batch_sizes = Histogram(DEPTH_BOUNDS)
+
+        self._subscribers: List[Callable[[TrafficUpdate], None]] = []
+
+        self._track_time_ns = 0
+        self._endpoint = ''
+        settings_service.subscribe(self._on_settings)
 
         super().__init__()
 
+    def _on_settings(self, settings: Settings):
+        self._track_time_ns = settings.traffic_track_time_s * NS_PER_S
+        # Connection to previous endpoint is closed by websocket consumer
+        self._endpoint = settings.traffic_endpoint
+
+    def histograms(self) -> Dict[str, Histogram]:
+        return {
+            **super().histograms(),
+            'parse_ns': self.parse_durations,
+            'geodesy_ns': self.geodesy_durations,
+            'batch_ns': self.batch_durations,
+            'batch_size': self.batch_sizes,
+        }
+
+    def subscribe(self, callback: Callable[[TrafficUpdate], None]):
+        """
+        Call `callback` with every traffic update. It is called from traffic service thread, so it has to be quick.
+        """
+        self._subscribers.append(callback)
+
     def trigger(self):
         """
         Attempt to connect to stratux websocket and process its messages.
         If connection is impossible or closed, it will repeat an attempt to re-connect after `delay` seconds.
         """
-        endpoint = self._settings_service.get_settings().traffic_endpoint
+        # Traffic is not going to be updated until connection is established
+        self._evict_traffic_state()
+
+        endpoint = self._endpoint
         logger.debug(f'Trying to connect to stratux /traffic endpoint at {endpoint}')
         with connect(endpoint) as websocket:
-            p = websocket.ping()
-            p.wait(10)
+            # Opening handshake is done at this point. Don't wait for a pong: when stratux has traffic to send right away,
+            # pong is queued behind messages nobody reads yet and the wait always times out.
             logger.info('Successfully connected to stratux /traffic endpoint')
-            self._consume_websocket(websocket)
+            self._consume_websocket(websocket, endpoint)
+
+    def _is_connected_to(self, endpoint: str) -> bool:
+        if endpoint != self._endpoint:
+            logger.info(f'Traffic endpoint changed to {self._endpoint}, reconnecting')
+            return False
+        return True
 
-    def _consume_websocket(self, websocket):
-        """Consume messages from websocket until shutdown or connection is unexpectedly closed"""
-        while not self._shutdown:
+    def _consume_websocket(self, websocket, endpoint: str):
+        """Consume messages from websocket until shutdown, endpoint change or connection is unexpectedly closed"""
+        while not self._shutdown and self._is_connected_to(endpoint):
             try:
                 # If we get a lot of messages in short period of time, this loop will iterate as fast as possible through them
-                message_str = websocket.recv(timeout=self.delay.total_seconds())
-                logger.debug(f'Traffic message received: {message_str}')
-                traffic_messages_logger.debug(message_str)
-                self._handle_traffic_message(message_str)
+                message_str = websocket.recv(timeout=self.message_timeout.total_seconds())
+                batch = [message_str]
+                self._drain_websocket(websocket, batch)
+                self._process_batch(batch)
             except TimeoutError:
+                self._evict_traffic_state()
+                self._refresh_geometry()
                 self._update_heartbeat()
                 continue
             except ConnectionClosed:
@@ -161,79 +330,274 @@ class TrafficServiceWorker(ServiceWorker):
             else:
                 self._update_heartbeat()
 
-    def _build_traffic_info(self, message: dict) -> TrafficInfo:
-        position = self._position_service.get_current_position()
+    async def trigger_async(self):
+        """
+        Same as `trigger`, but websocket is consumed by event loop instead of a dedicated thread
+        """
+        self._evict_traffic_state()
 
-        ts = message['Timestamp']
-        # try:
-        #     timestamp = datetime.datetime.fromisoformat(ts[:ts.find('.')])
-        # except:
-        #     logger.exception(f'Error converting timestamp from {ts}')
-        timestamp = datetime.datetime.utcnow()
-
-        traffic_info = {
-            'timestamp': timestamp,
-            'icao': str(message['Icao_addr']),
-            'registration': str(message['Reg']),
-            'tail': str(message['Tail']),
-            'gps': GPS(
-                lat=message['Lat'],
-                lng=message['Lng'],
-            ),
-            'speed_kmh': km_h(message['Speed'] if message['Speed_valid'] else 0),
-        }
+        endpoint = self._endpoint
+        logger.debug(f'Trying to connect to stratux /traffic endpoint at {endpoint}')
+        async with connect_async(endpoint) as websocket:
+            logger.info('Successfully connected to stratux /traffic endpoint')
+            await self._consume_websocket_async(websocket, endpoint)
 
-        altitude_m = int(meters(feet=message['Alt']))
-        # Service ceiling usually is at 12 000, so anything larger than that is wonky
-        if altitude_m > 15_000:
-            altitude_m = 0
+    async def _consume_websocket_async(self, websocket, endpoint: str):
+        """
+        Consume messages from websocket until shutdown, endpoint change or connection is closed.
+        Receiver task collects messages while previous batch is being processed, processing then takes up to `batch_size`
+        of them at once and yields to event loop before taking the next batch, so other services are not starved.
+        """
+        batch: List[str] = []
+        received = asyncio.Event()
 
-        traffic_info['altitude_m'] = altitude_m
+        async def receive():
+            try:
+                async for message_str in websocket:
+                    batch.append(message_str)
+                    received.set()
+            finally:
+                received.set()
+
+        receiver = asyncio.ensure_future(receive())
+
+        try:
+            while not self._shutdown and self._is_connected_to(endpoint):
+                try:
+                    await asyncio.wait_for(received.wait(), self.message_timeout.total_seconds())
+                except asyncio.TimeoutError:
+                    self._evict_traffic_state()
+                    self._refresh_geometry()
+                    self._update_heartbeat()
+                    continue
+
+                messages = batch[:self.batch_size]
+                del batch[:self.batch_size]
+                if not batch:
+                    received.clear()
+
+                if messages:
+                    try:
+                        self._process_batch(messages)
+                    except Exception:
+                        logger.exception('Error processing messages from websocket')
+                    self._update_heartbeat()
+
+                if batch:
+                    await asyncio.sleep(0)
+                    continue
+
+                if receiver.done():
+                    error = receiver.exception()
+                    if error is None or isinstance(error, ConnectionClosed):
+                        logger.warning('Websocket connection unexpectedly closed')
+                    else:
+                        logger.error('Error receiving message from websocket', exc_info=error)
+                    return
+        finally:
+            receiver.cancel()
+
+    def _process_batch(self, batch: List[str]):
+        start_ns = time.perf_counter_ns()
+
+        if self._capture_service is not None:
+            for message_str in batch:
+                self._capture_service.capture(message_str)
+        self._handle_traffic_messages(batch)
+        self._evict_traffic_state()
 
-        distance_m = int(position.distance(traffic_info['gps']))
-        # It is unlikely we receive a message from that far
-        if distance_m > 50_000:
-            distance_m = 0
+        self.batch_durations.record(time.perf_counter_ns() - start_ns)
+        self.batch_sizes.record(len(batch))
 
-        traffic_info['distance_m'] = distance_m
+    def _drain_websocket(self, websocket, batch: List[str]):
+        """
+        Append to `batch` messages that are already received by websocket, without waiting for new ones.
+        """
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(websocket.recv(timeout=0))
+            except (TimeoutError, ConnectionClosed):
+                # Closed connection will be noticed on the next recv
+                return
 
-        traffic_info['bearing_absolude_dg'] = int(position.absolute_bearing(traffic_info['gps']))
+    def _icao_name(self, icao_addr: int) -> str:
+        """
+        Return string icao for stratux address, every target gets a single string object for as long as it is tracked
+        """
+        icao = self._icao_names.get(icao_addr)
+        if icao is None:
+            icao = self._icao_names[icao_addr] = sys.intern(str(icao_addr))
+        return icao
 
-        obj = TrafficInfo(**traffic_info)
+    def _build_traffic_infos(self, messages: List[dict]) -> List[TrafficInfo]:
+        """
+        Build traffic info for a batch of messages, solving geodesy problem in one go for targets that moved.
 
-        return obj
+        Messages that bring nothing new are skipped: stratux re-sending a target it did not hear from again,
+        and targets whose last position fix is already older than `traffic_track_time_s`.
+        Message that can not be built is logged and skipped, the rest of the batch is not affected.
+        """
+        position = self._refresh_geometry()
+        received_ns = monotonic_ns()
+        outdated_ns = received_ns - self._track_time_ns
 
-    def _handle_traffic_message(self, message_str: str):
+        targets = []
+        moved = []
+        for message in messages:
+            try:
+                icao_addr = message['Icao_addr']
+                # Tracked traffic always has a name, new targets get one only once their message is accepted
+                icao = self._icao_names.get(icao_addr)
+                previous = None if icao is None else self._traffic_index.get(icao)
+                # Distances in index are relative to current geometry position, so they hold while target stays put
+                has_moved = previous is None or previous.gps != (message['Lat'], message['Lng'])
+
+                if previous is not None and previous.message_timestamp == message['Timestamp']:
+                    if not has_moved:
+                        self.messages_resent += 1
+                        continue
+                    # Extrapolated position moved, but there is no new fix
+                    fix_ns = previous.fix_ns
+                else:
+                    fix_ns = received_ns - int(message['Age'] * NS_PER_S)
+
+                if fix_ns < outdated_ns:
+                    self.messages_outdated += 1
+                    continue
+
+                gps = GPS(lat=float(message['Lat']), lng=float(message['Lng'])) if has_moved else None
+
+                if icao is None:
+                    icao = self._icao_name(icao_addr)
+            except Exception:
+                logger.exception(f'Error building traffic info from message: {message}')
+                continue
+
+            targets.append((message, fix_ns, icao, previous, has_moved))
+            if has_moved:
+                moved.append(gps)
+
+        geodesies = iter(self._inverse_batch(position, moved))
+        traffic_infos = []
+        for message, fix_ns, icao, previous, has_moved in targets:
+            geodesy = next(geodesies) if has_moved else None
+            try:
+                traffic_infos.append(build_traffic_info(message, received_ns, fix_ns, icao, geodesy, previous))
+            except Exception:
+                logger.exception(f'Error building traffic info from message: {message}')
+                if previous is None:
+                    self._icao_names.pop(message['Icao_addr'], None)
+
+        return traffic_infos
+
+    def _refresh_geometry(self) -> GPS:
         """
-        Process received traffic message string
+        Recompute distance and bearing to all tracked traffic if ownship moved more than `ownship_moved_m`
+        since they were computed, so traffic that stopped transmitting does not keep a stale distance.
+        Return ownship position traffic index is now relative to.
         """
-        self.messages_seen += 1
-        message = json.loads(message_str)
+        position = self._position_service.get_current_position()
+        previous = self._geometry_position
 
-        if not message['Position_valid']:
-            logger.info('Skipping traffic message with invalid position')
-            return
+        if previous is not None and (position == previous or previous.distance(position) < self.ownship_moved_m):
+            return previous
 
-        traffic_info = self._build_traffic_info(message)
+        self._geometry_position = position
+        if not self._traffic_index:
+            return position
 
-        with self._lock:
-            self._traffic_state[traffic_info.icao] = traffic_info
+        tracked = list(self._traffic_index)
+        geodesies = self._inverse_batch(position, [t.gps for t in tracked])
+        updated = []
+        for t, geodesy in zip(tracked, geodesies):
+            distance_m, bearing_dg = relative_geometry(geodesy)
+            updated.append(t._replace(distance_m=distance_m, bearing_absolude_dg=bearing_dg))
+        self._traffic_index.replace_all(updated)
 
-    def get_traffic_state(self) -> Dict[str, TrafficInfo]:
-        self._evict_traffic_state()
-        return self._traffic_state.copy()
+        logger.debug(f'Ownship moved to {position}, recomputed distances to {len(updated)} traffic')
+        self._publish_snapshot(updated=tuple(updated))
+
+        return position
 
-    def get_closest_traffic(self) -> List[TrafficInfo]:
-        return sorted(self.get_traffic_state().values(), key=lambda t: t.distance_m)
+    def _inverse_batch(self, position: GPS, targets: List[GPS]) -> List[Geodesy]:
+        if not targets:
+            return []
+
+        start_ns = time.perf_counter_ns()
+        geodesies = inverse_batch(position, targets)
+        self.geodesy_durations.record(time.perf_counter_ns() - start_ns)
+        return geodesies
+
+    def _handle_traffic_messages(self, message_strs: List[str]):
+        """
+        Process a batch of received traffic message strings
+        """
+        received_t = time.monotonic()
+        messages = []
+
+        for message_str in message_strs:
+            self.messages_seen += 1
+            start_ns = time.perf_counter_ns()
+            try:
+                message = self._decoder.decode(message_str)
+            except (ValueError, KeyError, TypeError):
+                logger.exception(f'Error decoding traffic message: {message_str}')
+                continue
+            finally:
+                self.parse_durations.record(time.perf_counter_ns() - start_ns)
+
+            if message is None:
+                logger.info('Skipping traffic message with invalid position')
+                continue
+
+            messages.append(message)
+
+        updated = tuple(self._build_traffic_infos(messages))
+        for traffic_info in updated:
+            self._traffic_index.update(traffic_info)
+
+        self._publish_snapshot(updated=updated, received_t=received_t)
+
+    def _publish_snapshot(self, updated: Tuple[TrafficInfo, ...] = (), evicted: Tuple[TrafficInfo, ...] = (), received_t: Optional[float] = None):
+        """
+        Replace current snapshot with a new one built from traffic index and notify subscribers
+        """
+        self._snapshot = TrafficSnapshot(
+            messages_seen=self.messages_seen,
+            traffic=tuple(self._traffic_index.closest()),
+        )
+
+        if not (updated or evicted):
+            return
+
+        update = TrafficUpdate(
+            snapshot=self._snapshot,
+            updated=updated,
+            evicted=evicted,
+            received_t=time.monotonic() if received_t is None else received_t,
+        )
+        for callback in self._subscribers:
+            try:
+                callback(update)
+            except Exception:
+                logger.exception(f'Error in traffic update subscriber {callback}')
+
+    def get_snapshot(self) -> TrafficSnapshot:
+        """
+        Return most recent traffic snapshot. Does not block.
+        """
+        return self._snapshot
 
     def _evict_traffic_state(self):
-        track_time_s = self._settings_service.get_settings().traffic_track_time_s
+        """
+        Stop tracking traffic that had no position fix for `traffic_track_time_s`.
+        Runs on every consumer loop iteration, so readers never have to.
+        """
+        evicted = self._traffic_index.evict_older_than(monotonic_ns() - self._track_time_ns)
 
-        now = datetime.datetime.utcnow()
-        track_time = datetime.timedelta(seconds=track_time_s)
+        for traffic_info in evicted:
+            logger.debug(f'{traffic_info.icao} has outdated')
+            self._icao_names.pop(int(traffic_info.icao), None)
 
-        with self._lock:
-            for icao, traffic_state in list(self._traffic_state.items()):
-                if (now - traffic_state.timestamp) > track_time:
-                    logger.debug(f'{icao} has outdated')
-                    self._traffic_state.pop(icao)
+        if evicted:
+            self._publish_snapshot(evicted=tuple(evicted))
@@ -1,31 +1,58 @@
 import datetime
+import functools
 import time
+from typing import List, Optional, Tuple, Dict
 
 from PIL import ImageFont, Image, ImageDraw
-from luma.core.interface.serial import spi
 from luma.core.sprite_system import framerate_regulator
-from luma.lcd.device import st7735
 
 from stratux_companion.alarm_service import AlarmServiceWorker
+from stratux_companion.display import create_device
 from stratux_companion.hardware_status_service import HardwareStatusService
 from stratux_companion.position_service import PositionServiceWorker
-from stratux_companion.settings_service import SettingsService
+from stratux_companion.settings_service import SettingsService, Settings
 from stratux_companion.traffic_service import TrafficServiceWorker
-from stratux_companion.util import ServiceWorker
+from stratux_companion.util import ServiceWorker, monotonic_ns, seconds_ns, Histogram
+
+
+FONT_FILE = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+
+
+@functools.lru_cache(maxsize=None)
+def get_font(size: int) -> ImageFont.FreeTypeFont:
+    """
+    Return font loaded once per process
+    """
+    return ImageFont.truetype(FONT_FILE, size, encoding="unic")
+
+
+@functools.lru_cache(maxsize=256)
+def render_line(text: str, font: ImageFont.FreeTypeFont, mode: str, size: Tuple[int, int]) -> Image.Image:
+    """
+    Return image of `size` with `text` drawn on it. Images are shared between all screens, never draw on them.
+    """
+    line_image = Image.new(mode=mode, size=size)
+    ImageDraw.Draw(line_image).text((0, 0), text=text, font=font)
+    return line_image
 
 
 class Screen:
     """
     Screen incapsulates logic of drawing specific things on the display.
+    Screens are meant to be created once and updated every frame, each one owns its frame image.
     """
     def __init__(self, *, device):
         self._image = Image.new(mode=device.mode, size=device.size)
         self._draw = ImageDraw.Draw(self._image)
 
-        self._font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 11, encoding="unic")
+        self._font = get_font(11)
 
-    def update(self):
+    def update(self) -> bool:
+        """
+        Redraw screen image. Return True if image has changed.
+        """
         self._clear()
+        return True
 
     def _clear(self):
         self._draw.rectangle((0, 0, self._image.width, self._image.height), fill='black')
@@ -38,27 +65,42 @@ class Screen:
 class LinedScreen(Screen):
     """
     Lined screen allows displaying text in lines and tracks each line position itself.
+    Only lines that have changed since last update are redrawn.
     """
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
         self._x_offset = 3
         self._y_offset = 3
 
-    def update(self):
-        super().update()
-        self._y_offset = 3
+        # Fixed line height, so changing one line never moves the others
+        self._line_height = self._font.getbbox('Ay')[3] + 2
 
-        for line in self.get_lines():
-            self.println(line)
+        self._line_size = (self._image.width - self._x_offset, self._line_height)
+        self._drawn_lines: List[str] = []
 
-    def get_lines(self):
-        raise NotImplementedError()
+    def update(self) -> bool:
+        lines = self.get_lines()
+        changed = False
 
-    def println(self, text):
-        bbox = self._draw.textbbox((self._x_offset, self._y_offset), text=text, font=self._font)
-        self._draw.text((self._x_offset, self._y_offset), text=text, font=self._font)
-        self._y_offset = bbox[3] + 2
+        for n in range(max(len(lines), len(self._drawn_lines))):
+            text = lines[n] if n < len(lines) else ''
+            drawn = self._drawn_lines[n] if n < len(self._drawn_lines) else None
+
+            if text != drawn:
+                # Blank part of the line image is black, so pasting it also clears previous text
+                line_image = render_line(text, self._font, self._image.mode, self._line_size)
+                self._image.paste(line_image, (self._x_offset, 3 + n * self._line_height))
+                changed = True
+
+        self._drawn_lines = lines
+        self._y_offset = 3 + len(lines) * self._line_height
+
+        return changed
+
+    def get_lines(self) -> List[str]:
+        raise NotImplementedError()
 
 
 class TrafficScreen(LinedScreen):
@@ -74,16 +116,17 @@ class TrafficScreen(LinedScreen):
         super().__init__(**kwargs)
 
     def get_lines(self):
-        traffic = self._traffic_service.get_closest_traffic()
+        snapshot = self._traffic_service.get_snapshot()
+        traffic = snapshot.closest(limit=self.max_traffic)
 
         lines = [
-            f'Messages: {self._traffic_service.messages_seen}'
+            f'Messages: {snapshot.messages_seen}'
         ]
 
         if not traffic:
             lines.append('No traffic detected')
         else:
-            for t in traffic[:self.max_traffic]:
+            for t in traffic:
                 lines.append(f"{t.registration[:3] if t.registration else t.icao[:3]} D:{t.distance_m}m A:{t.altitude_m}m")
 
         return lines
@@ -118,7 +161,8 @@ class StatusScreen(LinedScreen):
         self._position_service = position_service
         self._hardware_status_service = hardware_status_service
 
-        self._power_readings = []
+        # Hardware sample the power graph was drawn for
+        self._graph_samples = -1
 
         super().__init__(**kwargs)
 
@@ -131,6 +175,8 @@ class StatusScreen(LinedScreen):
         watts = round(self._hardware_status_service.power, 1)
         temp = round(self._hardware_status_service.cpu_temp, 0)
         cpu = round(self._hardware_status_service.cpu_usage, 0)
+        minutes = self._hardware_status_service.battery_minutes_remaining
+        remaining = f' {int(minutes)}min' if minutes is not None else ''
 
         return [
             f'Lat: {gps.lat}',
@@ -139,37 +185,43 @@ class StatusScreen(LinedScreen):
             f'CPU: {cpu}%',
             f'Temp: {temp}C',
             f'Batt: {battery_p}% {volts}v ',
-            f'  {watts}W',
+            f'  {watts}W{remaining}',
         ]
 
-    def update(self):
-        super().update()
-
-        # self.render_power_graph()
-
-    # def render_power_graph(self):
-    #     dot_size = 2
-    #     width = 100
-    #     height = 30
-    #     max_readings = width // dot_size
-    #     max_read_value = 15
-    #
-    #     start_x, start_y = self._x_offset, self._y_offset
-    #     end_x = start_x + width
-    #     end_y = start_y + height
-    #
-    #     self._power_readings.append(self._hardware_status_service.power)
-    #     if len(self._power_readings) > max_readings:
-    #         self._power_readings.pop(0)
-    #
-    #     slope = height / max_read_value
-    #
-    #     self._draw.rectangle((start_x, start_y, end_x, end_y), outline='red')
-    #
-    #     for n, reading in enumerate(self._power_readings):
-    #         x = start_x + n*2
-    #         y = end_y - round(slope * reading)
-    #         self._draw.rectangle((x, y, x + dot_size // 2, y + dot_size // 2), fill='red')
+    def update(self) -> bool:
+        changed = super().update()
+
+        # Graph only changes with new hardware samples
+        samples = self._hardware_status_service.samples
+        if samples != self._graph_samples:
+            self.render_power_graph()
+            self._graph_samples = samples
+            changed = True
+
+        return changed
+
+    def render_power_graph(self):
+        dot_size = 2
+        width = 100
+        max_readings = width // dot_size
+        max_read_value = 15
+
+        start_x, start_y = self._x_offset, self._y_offset
+        # Whatever is left below the lines
+        height = self._image.height - start_y - 1
+        end_x = start_x + width
+        end_y = start_y + height
+
+        readings = self._hardware_status_service.power_history.values()[-max_readings:]
+
+        slope = height / max_read_value
+
+        self._draw.rectangle((start_x, start_y, end_x, end_y), outline='red', fill='black')
+
+        for n, reading in enumerate(readings):
+            x = start_x + n * dot_size
+            y = end_y - round(slope * min(reading, max_read_value))
+            self._draw.rectangle((x, y, x + dot_size // 2, y + dot_size // 2), fill='red')
 
 
 class UIServiceWorker(ServiceWorker):
@@ -179,7 +231,11 @@ class UIServiceWorker(ServiceWorker):
     # Framerate regulator will do the delays
     delay = datetime.timedelta(seconds=0)
 
+    # Traffic and status screens take turns this long while nothing is alarming
+    screen_carousel_delay = datetime.timedelta(seconds=10)
+
     _screen: Screen
+    _displayed_screen: Optional[Screen] = None
 
     def __init__(self, traffic_service: TrafficServiceWorker, settings_service: SettingsService, position_service: PositionServiceWorker, alarm_service: AlarmServiceWorker, hardware_status_service: HardwareStatusService):
         self._traffic_service = traffic_service
@@ -190,52 +246,65 @@ class UIServiceWorker(ServiceWorker):
 
         settings = settings_service.get_settings()
 
-        serial = spi(port=0, device=0, gpio_DC=24, gpio_RST=25)
-        device = st7735(
-            serial_interface=serial,
-            width=128,
-            height=128,
-            v_offset=2,
-            h_offset=1,
-            bgr=True,
-            rotate=settings.display_rotation,
-            gpio_LIGHT=23,
-            active_low=False
-        )
-
-        self._device = device
-        self._framerate_regulator = framerate_regulator(fps=settings.display_fps)
-        self._device.clear()
-        self._device.backlight(True)
+        self._device = create_device(settings)
+        settings_service.subscribe(self._on_settings)
+
+        # Nanoseconds spent rendering every frame, and sending changed frames to display
+        self.render_durations = Histogram()
+        self.display_durations = Histogram()
+
+        self._screen_carousel_ns = monotonic_ns()
 
-        self._screen_carousel_t = time.time()
+        self._traffic_screen = TrafficScreen(device=self._device, traffic_service=self._traffic_service)
+        self._alarm_screen = AlarmScreen(device=self._device, alarm_service=self._alarm_service)
+        self._status_screen = StatusScreen(device=self._device, position_service=self._position_service, hardware_status_service=self._hardware_status_service)
 
         self.set_traffic_screen()
 
         super().__init__()
 
+    def _on_settings(self, settings: Settings):
+        self._framerate_regulator = framerate_regulator(fps=settings.display_fps)
+
+    def histograms(self) -> Dict[str, Histogram]:
+        return {
+            **super().histograms(),
+            'render_ns': self.render_durations,
+            'display_ns': self.display_durations,
+        }
+
     def set_traffic_screen(self):
-        self._screen = TrafficScreen(device=self._device, traffic_service=self._traffic_service)
+        self._screen = self._traffic_screen
 
     def set_alarm_screen(self):
-        self._screen = AlarmScreen(device=self._device, alarm_service=self._alarm_service)
+        self._screen = self._alarm_screen
 
     def set_status_screen(self):
-        self._screen = StatusScreen(device=self._device, position_service=self._position_service, hardware_status_service=self._hardware_status_service)
+        self._screen = self._status_screen
 
     def trigger(self):
         with self._framerate_regulator:
+            start_ns = time.perf_counter_ns()
             self._switch_screens()
-            self._screen.update()
-            self._device.display(self._screen.image)
+            changed = self._screen.update()
+            rendered_ns = time.perf_counter_ns()
+            self.render_durations.record(rendered_ns - start_ns)
+
+            # Display keeps showing the last frame, so only send it a different one.
+            # Device framebuffer then pushes only changed segments over SPI.
+            if changed or self._screen is not self._displayed_screen:
+                self._device.display(self._screen.image)
+                self._displayed_screen = self._screen
+                self.display_durations.record(time.perf_counter_ns() - rendered_ns)
 
     def _switch_screens(self):
         if self._alarm_service.alarming_traffic():
             self.set_alarm_screen()
         else:
-            if time.time() - self._screen_carousel_t > 10:
-                self._screen_carousel_t = time.time()
-                if isinstance(self._screen, TrafficScreen):
+            now_ns = monotonic_ns()
+            if now_ns - self._screen_carousel_ns > seconds_ns(self.screen_carousel_delay):
+                self._screen_carousel_ns = now_ns
+                if self._screen is self._traffic_screen:
                     self.set_status_screen()
                 else:
                     self.set_traffic_screen()
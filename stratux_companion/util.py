@@ -1,10 +1,15 @@
 import abc
+import asyncio
 import datetime
 import logging
 import time
+from array import array
+from bisect import bisect_left
+from pathlib import Path
 from queue import Queue
-from typing import NamedTuple, Any
-import geopy.distance
+from threading import Event
+from typing import NamedTuple, Any, Iterable, List, Optional, Sequence, Dict, IO
+
 from geographiclib.geodesic import Geodesic
 
 logger = logging.getLogger(__name__)
@@ -23,57 +28,288 @@ class GPS(NamedTuple):
         return self.distance(other)
 
     def distance(self, other: 'GPS') -> float:
-        return geopy.distance.geodesic(tuple(self), tuple(other)).meters
+        return self.inverse(other).distance_m
 
     def absolute_bearing(self, other: 'GPS') -> float:
-        result = Geodesic.WGS84.Inverse(self.lat, self.lng, other.lat, other.lng)
+        return self.inverse(other).bearing_dg
+
+    def inverse(self, other: 'GPS') -> 'Geodesy':
+        """
+        Return distance and absolute bearing to `other` computed with a single WGS84 inverse solve
+        """
+        result = Geodesic.WGS84.Inverse(self.lat, self.lng, other.lat, other.lng, _INVERSE_OUTMASK)
+        azi1 = result['azi1']
+        if azi1 < 0:
+            azi1 += 360
+        return Geodesy(distance_m=result['s12'], bearing_dg=azi1)
+
+    def destination(self, bearing_dg: float, distance_m: float) -> 'GPS':
+        """
+        Return point `distance_m` away from this one along absolute bearing `bearing_dg`
+        """
+        result = Geodesic.WGS84.Direct(self.lat, self.lng, bearing_dg, distance_m, _DIRECT_OUTMASK)
+        return GPS(lat=result['lat2'], lng=result['lon2'])
+
+
+class Geodesy(NamedTuple):
+    """
+    Relative geometry between two points: geodesic distance and absolute (true) bearing from the first point
+    """
+    distance_m: float
+    bearing_dg: float
+
+
+# Ask geographiclib only for what we use: skips reduced length and geodesic scale computations
+_INVERSE_OUTMASK = Geodesic.DISTANCE | Geodesic.AZIMUTH
+_DIRECT_OUTMASK = Geodesic.LATITUDE | Geodesic.LONGITUDE
+
+
+def inverse_batch(origin: GPS, targets: Iterable[GPS]) -> List[Geodesy]:
+    """
+    Compute distance and absolute bearing from `origin` to every point in `targets`.
+    Each pair costs exactly one WGS84 inverse solve, results are returned in the same order as `targets`.
+    """
+    inverse = Geodesic.WGS84.Inverse
+    lat1, lng1 = origin
+    results = []
+
+    for lat2, lng2 in targets:
+        result = inverse(lat1, lng1, lat2, lng2, _INVERSE_OUTMASK)
         azi1 = result['azi1']
         if azi1 < 0:
             azi1 += 360
-        return azi1
+        results.append(Geodesy(distance_m=result['s12'], bearing_dg=azi1))
+
+    return results
+
+
+def parse_timestamp(ts: str) -> datetime.datetime:
+    """
+    Parse stratux timestamp, like 2024-01-12T05:30:20.777200261Z, into naive UTC datetime.
+    Go always formats these the same way, so fields are sliced at fixed offsets. Nanoseconds are truncated.
+    """
+    fraction = ts[20:26].rstrip('Z') if ts[19:20] == '.' else ''
+    return datetime.datetime(
+        int(ts[0:4]), int(ts[5:7]), int(ts[8:10]),
+        int(ts[11:13]), int(ts[14:16]), int(ts[17:19]),
+        int(fraction.ljust(6, '0')) if fraction else 0,
+    )
+
+
+NS_PER_S = 1_000_000_000
+
+
+def seconds_ns(delta: datetime.timedelta) -> int:
+    """
+    Convert timedelta to integer nanoseconds, for comparing with `monotonic_ns`
+    """
+    return int(delta.total_seconds() * NS_PER_S)
+
+
+class Clock:
+    """
+    Monotonic clock. Unlike wall clock, it does not jump when system time is set,
+    which happens on GPS time sync when Pi boots without RTC.
+    """
+
+    def monotonic_ns(self) -> int:
+        return time.monotonic_ns()
+
+
+class FakeClock(Clock):
+    """
+    Clock that only moves when advanced, for tests and for replaying captures in their own time
+    """
+
+    def __init__(self, start_ns: int = 0):
+        self._now_ns = start_ns
+
+    def monotonic_ns(self) -> int:
+        return self._now_ns
+
+    def advance(self, seconds: float):
+        self._now_ns += int(seconds * NS_PER_S)
+
+
+_clock: Clock = Clock()
+
+
+def monotonic_ns() -> int:
+    """
+    Current time of the clock in use, in nanoseconds. Only differences between two readings are meaningful.
+    """
+    return _clock.monotonic_ns()
+
+
+def set_clock(clock: Clock) -> Clock:
+    """
+    Make services read time from `clock`, return clock that was used before
+    """
+    global _clock
+    previous, _clock = _clock, clock
+    return previous
+
+
+# Histogram bucket upper bounds for durations: 1, 2, 5 steps from 1 microsecond to 10 seconds
+DURATION_BOUNDS_NS = tuple(m * 10 ** e for e in range(3, 10) for m in (1, 2, 5)) + (10 * NS_PER_S,)
+
+# Histogram bucket upper bounds for queue depths
+DEPTH_BOUNDS = (0, 1, 2, 4, 8, 16, 32, 64)
+
+
+class Histogram:
+    """
+    Counts integer samples into fixed buckets, so recording a sample is a bisect and a few additions.
+    Bucket `i` counts samples up to `bounds[i]`, last bucket counts samples above all bounds.
+
+    Samples may be recorded from any thread, a sample recorded while `snapshot` resets the histogram can be lost.
+    """
+
+    def __init__(self, bounds: Sequence[int] = DURATION_BOUNDS_NS):
+        self.bounds = tuple(bounds)
+        self._reset()
+
+    def _reset(self):
+        self._counts = array('q', bytes(8 * (len(self.bounds) + 1)))
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value: int):
+        self._counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> int:
+        """
+        Return upper bound of the bucket holding `q` quantile, or max for samples above all bounds
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self._counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self, reset: bool = False) -> Dict[str, Any]:
+        """
+        Return summary and bucket counts, starting a new histogram if `reset` is set
+        """
+        snapshot = {
+            'count': self.count,
+            'mean': self.total // self.count if self.count else 0,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'max': self.max,
+            'buckets': self._counts.tolist(),
+        }
+        if reset:
+            self._reset()
+        return snapshot
 
 
 class ServiceWorker(metaclass=abc.ABCMeta):
     """
     Service worker provides a scafoolding for user logic to be ran every `delay` seconds.
     Tracks heartbeat and supports graceful shutdown.
+
+    Worker can be run in its own thread with `run`, or as a task in asyncio event loop with `run_async`.
+    In both cases `wake` makes it run next trigger right away instead of waiting for `delay`.
+    Duration of every trigger is recorded in `trigger_durations`.
     """
 
     delay: datetime.timedelta = datetime.timedelta(seconds=5)
 
     def __init__(self):
-        self._heartbeat = datetime.datetime.utcnow().replace(year=1970)  # very old heartbeat as default
+        self._heartbeat: Optional[int] = None  # No heartbeat yet
         self._shutdown = False
 
+        self._wakeup = Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._async_wakeup: Optional[asyncio.Event] = None
+
+        # Nanoseconds every trigger took, including waiting done inside of it
+        self.trigger_durations = Histogram()
+
     def run(self):
         """
         Run the loop
         """
         while not self._shutdown:
+            # Cleared before trigger, so wake ups requested while it runs are not lost
+            self._wakeup.clear()
+            start_ns = time.perf_counter_ns()
             try:
                 self.trigger()
                 self._update_heartbeat()  # Update heartbeat only if trigger executed successfully
             except:
                 logger.exception(f'Unhandled error in {self.__class__.__name__}.trigger')
+            self.trigger_durations.record(time.perf_counter_ns() - start_ns)
 
             if not self._shutdown:
-                time.sleep(self.delay.total_seconds())
+                self._wakeup.wait(self.delay.total_seconds())
+
+    async def run_async(self):
+        """
+        Run the loop in asyncio event loop
+        """
+        self._loop = asyncio.get_running_loop()
+        self._async_wakeup = asyncio.Event()
+
+        while not self._shutdown:
+            self._async_wakeup.clear()
+            start_ns = time.perf_counter_ns()
+            try:
+                await self.trigger_async()
+                self._update_heartbeat()
+            except Exception:
+                logger.exception(f'Unhandled error in {self.__class__.__name__}.trigger_async')
+            self.trigger_durations.record(time.perf_counter_ns() - start_ns)
+
+            if not self._shutdown:
+                try:
+                    await asyncio.wait_for(self._async_wakeup.wait(), self.delay.total_seconds())
+                except asyncio.TimeoutError:
+                    pass
+
+    def wake(self):
+        """
+        Run next trigger now instead of waiting for `delay`. Safe to call from any thread.
+        """
+        self._wakeup.set()
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._async_wakeup.set)
+            except RuntimeError:
+                # Event loop is already closed
+                pass
 
     def shutdown(self):
         """
         Set shutdown flag
         """
         self._shutdown = True
+        self.wake()
 
     @property
-    def heartbeat(self) -> datetime.datetime:
+    def heartbeat(self) -> Optional[int]:
         """
-        Return timestamp of last heartbeat
+        Return `monotonic_ns()` of last heartbeat, or None if there was none yet
         """
         return self._heartbeat
 
     def _update_heartbeat(self):
-        self._heartbeat = datetime.datetime.utcnow()
+        self._heartbeat = monotonic_ns()
+
+    def histograms(self) -> Dict[str, Histogram]:
+        """
+        Return histograms exported by MetricsServiceWorker, by name. Subclasses add their own stages.
+        """
+        return {'trigger_ns': self.trigger_durations}
 
     def trigger(self):
         """
@@ -81,6 +317,12 @@ class ServiceWorker(metaclass=abc.ABCMeta):
         """
         raise NotImplementedError()
 
+    async def trigger_async(self):
+        """
+        User code runs here in asyncio runtime. By default blocking `trigger` is ran in executor.
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self.trigger)
+
 
 class QueueConsumingServiceWorker(ServiceWorker):
     """
@@ -129,18 +371,139 @@ def km_h(knots: float) -> float:
     return knots * 1.85200
 
 
+class RingBuffer:
+    """
+    Fixed size history of most recent float samples and `monotonic_ns()` times they were taken at.
+    Samples are stored in preallocated arrays, so appending never allocates.
+    """
+
+    def __init__(self, capacity: int):
+        self._capacity = capacity
+        self._values = array('d', bytes(8 * capacity))
+        self._times = array('q', bytes(8 * capacity))
+
+        self._next = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, value: float, time_ns: int):
+        self._values[self._next] = value
+        self._times[self._next] = time_ns
+        self._next = (self._next + 1) % self._capacity
+        self._count = min(self._count + 1, self._capacity)
+
+    @property
+    def last(self) -> Optional[float]:
+        if not self._count:
+            return None
+        return self._values[self._next - 1]
+
+    @property
+    def last_time_ns(self) -> Optional[int]:
+        if not self._count:
+            return None
+        return self._times[self._next - 1]
+
+    def values(self) -> List[float]:
+        """
+        Return samples, oldest first
+        """
+        return self._ordered(self._values)
+
+    def min(self) -> Optional[float]:
+        return min(self.values()) if self._count else None
+
+    def max(self) -> Optional[float]:
+        return max(self.values()) if self._count else None
+
+    def mean(self) -> Optional[float]:
+        return sum(self.values()) / self._count if self._count else None
+
+    def trend(self) -> float:
+        """
+        Return least squares slope of samples, in units per second. 0 if there are not enough samples.
+        """
+        if self._count < 2:
+            return 0.0
+
+        values = self.values()
+        times = self._ordered(self._times)
+        t0 = times[0]
+        xs = [(t - t0) / NS_PER_S for t in times]
+
+        mean_x = sum(xs) / self._count
+        mean_y = sum(values) / self._count
+        var_x = sum((x - mean_x) ** 2 for x in xs)
+        if not var_x:
+            return 0.0
+
+        return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, values)) / var_x
+
+    def _ordered(self, column: array) -> List:
+        if self._count < self._capacity:
+            return column[:self._count].tolist()
+        return column[self._next:].tolist() + column[:self._next].tolist()
+
+
 class Throttle:
     def __init__(self, delta: datetime.timedelta):
-        self._delta = delta
-        self._last_t = time.time()
+        self._delta_ns = seconds_ns(delta)
+        self._last_ns = monotonic_ns()
 
     @property
     def is_throttled(self) -> bool:
         """
         Return True `delta` seconds has passed since last time this function returned True
         """
-        new_t = time.time()
-        if (new_t - self._last_t) > self._delta.total_seconds():
-            self._last_t = new_t
+        new_ns = monotonic_ns()
+        if (new_ns - self._last_ns) > self._delta_ns:
+            self._last_ns = new_ns
             return False
         return True
+
+
+class DailyRotatingFile:
+    """
+    Append only file rotated at midnight like logging TimedRotatingFileHandler does:
+    file written on a previous day is renamed with its date appended, and only `backup_count` newest of those are kept.
+    """
+
+    def __init__(self, file: Path, backup_count: int, mode: str = 'ab'):
+        self._file = file
+        self._backup_count = backup_count
+        self._mode = mode
+
+        self._stream: Optional[IO] = None
+        self._stream_date: Optional[datetime.date] = None
+
+    def stream(self) -> IO:
+        """
+        Return stream to append to, rotating the file first if the day has changed
+        """
+        today = datetime.date.today()
+        if self._stream is not None and self._stream_date == today:
+            return self._stream
+
+        self.close()
+
+        if self._file.exists():
+            file_date = datetime.date.fromtimestamp(self._file.stat().st_mtime)
+            if file_date != today:
+                self._file.rename(self._file.with_name(f'{self._file.name}.{file_date.isoformat()}'))
+                self._remove_old_backups()
+
+        self._stream = self._file.open(self._mode)
+        self._stream_date = today
+        return self._stream
+
+    def _remove_old_backups(self):
+        backups = sorted(self._file.parent.glob(f'{self._file.name}.????-??-??'))
+        for backup in backups[:-self._backup_count]:
+            backup.unlink()
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
@@ -4,6 +4,8 @@ import pytest
 
 from stratux_companion.hardware_status_service import HardwareStatusService
 from stratux_companion.settings_service import SettingsService
+from stratux_companion.traffic_service import TrafficInfo
+from stratux_companion.util import GPS, NS_PER_S
 
 
 @pytest.fixture
@@ -20,3 +22,33 @@ def settings_service(settings_file):
 def hardware_status_service(settings_service):
     return HardwareStatusService(settings_service)
 
+
+
+@pytest.fixture
+def make_traffic_info():
+    """
+    Return function building traffic info with sensible defaults, fix and position at `fix_s` seconds
+    """
+    def make(icao: str = '1', fix_s: float = 0, distance_m: int = 1_000, bearing_dg: int = 0, altitude_m: int = 1_000,
+             speed_kmh: int = 0, track_dg: int = 0, vertical_speed_ms: float = 0.0, speed_valid: bool = True) -> TrafficInfo:
+        fix_ns = int(fix_s * NS_PER_S)
+        return TrafficInfo(
+            received_ns=fix_ns,
+            fix_ns=fix_ns,
+            position_ns=fix_ns,
+            extrapolated=False,
+            message_timestamp='',
+            gps=GPS(lat=30.0, lng=-97.0),
+            altitude_m=altitude_m,
+            distance_m=distance_m,
+            speed_kmh=speed_kmh,
+            bearing_absolude_dg=bearing_dg,
+            track_dg=track_dg,
+            vertical_speed_ms=vertical_speed_ms,
+            speed_valid=speed_valid,
+            icao=icao,
+            registration='',
+            tail='',
+        )
+
+    return make
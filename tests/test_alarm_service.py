@@ -0,0 +1,104 @@
+import pytest
+
+from stratux_companion.alarm_service import AlarmServiceWorker
+from stratux_companion.position_service import PositionInfo
+from stratux_companion.traffic_service import TrafficSnapshot, TrafficUpdate
+
+
+class StaticPosition:
+    def position_info(self) -> PositionInfo:
+        return PositionInfo(altitude_msl_m=0, altitude_hae_m=0, satellites=8)
+
+
+class FakeTrafficService:
+    def __init__(self):
+        self.snapshot = TrafficSnapshot(messages_seen=0, traffic=())
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def get_snapshot(self) -> TrafficSnapshot:
+        return self.snapshot
+
+    def publish(self, traffic=(), updated=(), evicted=()):
+        self.snapshot = TrafficSnapshot(messages_seen=0, traffic=tuple(traffic))
+        update = TrafficUpdate(snapshot=self.snapshot, updated=tuple(updated), evicted=tuple(evicted), received_t=0.0)
+        for callback in self._subscribers:
+            callback(update)
+
+
+class FakeHardwareStatus:
+    battery_percent = 100
+    battery_minutes_remaining = None
+
+
+class FakeSoundService:
+    def __init__(self):
+        self.spoken = []
+
+    def prerender(self, fragments):
+        pass
+
+    def play_sound(self, text, priority=None, key=None):
+        self.spoken.append(key)
+
+    def play_beep(self, beep):
+        pass
+
+
+@pytest.fixture()
+def traffic_service():
+    return FakeTrafficService()
+
+
+@pytest.fixture()
+def sound_service():
+    return FakeSoundService()
+
+
+@pytest.fixture()
+def alarm_service(traffic_service, settings_service, sound_service):
+    return AlarmServiceWorker(traffic_service, settings_service, sound_service, FakeHardwareStatus(), StaticPosition())
+
+
+def test_target_evicted_during_reevaluation_is_not_alarming(alarm_service, traffic_service, sound_service, make_traffic_info):
+    target = make_traffic_info(icao='42', distance_m=1_000)
+    traffic_service.publish(traffic=[target], updated=[target])
+    assert [t.icao for t in alarm_service.alarming_traffic()] == ['42']
+
+    evaluate = alarm_service._evaluate
+
+    def evaluate_then_evict(targets, settings):
+        alarm_service._evaluate = evaluate
+        evaluated = evaluate(targets, settings)
+        # Traffic thread evicts target after re-evaluation took its snapshot
+        traffic_service.publish(evicted=[target])
+        return evaluated
+
+    alarm_service._evaluate = evaluate_then_evict
+    alarm_service._reevaluate()
+
+    assert alarm_service.alarming_traffic() == []
+    sound_service.spoken.clear()
+    alarm_service.monitor_traffic()
+    assert sound_service.spoken == []
+
+
+def test_new_alarm_announces_only_new_target(alarm_service, traffic_service, sound_service, make_traffic_info):
+    first = make_traffic_info(icao='1', distance_m=1_000)
+    second = make_traffic_info(icao='2', distance_m=2_000)
+
+    traffic_service.publish(traffic=[first], updated=[first])
+    alarm_service.monitor_traffic()
+    assert sound_service.spoken == ['1']
+
+    sound_service.spoken.clear()
+    traffic_service.publish(traffic=[first, second], updated=[second])
+    alarm_service.monitor_traffic()
+    assert sound_service.spoken == ['2']
+
+    # Periodic re-announcement
+    sound_service.spoken.clear()
+    alarm_service.monitor_traffic()
+    assert sound_service.spoken == ['1', '2']
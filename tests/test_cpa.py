@@ -0,0 +1,130 @@
+import pytest
+
+from stratux_companion.alarm_service import AlarmServiceWorker
+from stratux_companion.cpa import predict_cpa, Velocity
+from stratux_companion.settings_service import Settings
+from stratux_companion.util import NS_PER_S
+
+STATIONARY = Velocity(track_dg=0, speed_kmh=0, vertical_speed_ms=0)
+# 100 m/s
+SPEED_KMH = 360
+
+
+def cpa(traffic_info, ownship=STATIONARY, horizon_s=60, now_s=0):
+    return predict_cpa([traffic_info], ownship, horizon_s, int(now_s * NS_PER_S))[0]
+
+
+def test_head_on(make_traffic_info):
+    result = cpa(make_traffic_info(distance_m=5_000, bearing_dg=0, speed_kmh=SPEED_KMH, track_dg=180))
+
+    assert result.closing
+    assert result.time_s == pytest.approx(50)
+    assert result.distance_m == pytest.approx(0, abs=1)
+
+
+def test_passing_abeam(make_traffic_info):
+    # 1000 m east of ownship track, 5000 m north, flying south
+    result = cpa(make_traffic_info(distance_m=5_099, bearing_dg=11, speed_kmh=SPEED_KMH, track_dg=180))
+
+    assert result.closing
+    assert result.time_s == pytest.approx(50, abs=0.5)
+    assert result.distance_m == pytest.approx(1_000, abs=30)
+
+
+def test_moving_away(make_traffic_info):
+    result = cpa(make_traffic_info(distance_m=5_000, bearing_dg=0, speed_kmh=SPEED_KMH, track_dg=0))
+
+    assert not result.closing
+    assert result.time_s == 0
+    assert result.distance_m == pytest.approx(5_000)
+
+
+def test_clamped_to_horizon(make_traffic_info):
+    result = cpa(make_traffic_info(distance_m=20_000, bearing_dg=0, speed_kmh=SPEED_KMH, track_dg=180), horizon_s=60)
+
+    assert result.closing
+    assert result.time_s == 60
+    assert result.distance_m == pytest.approx(14_000)
+
+
+def test_position_is_moved_to_now(make_traffic_info):
+    result = cpa(make_traffic_info(fix_s=0, distance_m=5_000, bearing_dg=0, speed_kmh=SPEED_KMH, track_dg=180), now_s=10)
+
+    assert result.time_s == pytest.approx(40)
+
+
+def test_ownship_motion(make_traffic_info):
+    ownship = Velocity(track_dg=0, speed_kmh=SPEED_KMH, vertical_speed_ms=0)
+    result = cpa(make_traffic_info(distance_m=5_000, bearing_dg=0), ownship=ownship)
+
+    assert result.closing
+    assert result.time_s == pytest.approx(50)
+
+
+def test_altitude_at_cpa(make_traffic_info):
+    result = cpa(make_traffic_info(distance_m=5_000, bearing_dg=0, speed_kmh=SPEED_KMH, track_dg=180, altitude_m=2_000, vertical_speed_ms=-10))
+
+    assert result.altitude_m == pytest.approx(1_500)
+
+
+def test_no_relative_motion_is_closing(make_traffic_info):
+    result = cpa(make_traffic_info(distance_m=3_000))
+
+    assert result.closing
+    assert result.distance_m == pytest.approx(3_000)
+
+
+def test_unknown_speed_is_closing(make_traffic_info):
+    # Ownship flies away from target, which would look diverging if target was taken for stationary
+    ownship = Velocity(track_dg=180, speed_kmh=SPEED_KMH, vertical_speed_ms=0)
+    result = cpa(make_traffic_info(distance_m=3_000, bearing_dg=0, speed_valid=False), ownship=ownship)
+
+    assert result.closing
+    assert result.distance_m == 3_000
+
+
+@pytest.fixture
+def settings():
+    return Settings(max_distance_m=10_000, max_altitude_m=3_000, cpa_distance_m=1_500, cpa_horizon_s=60)
+
+
+def is_alarming(traffic_info, settings, ownship=STATIONARY):
+    return AlarmServiceWorker.is_alarming(traffic_info, cpa(traffic_info, ownship, settings.cpa_horizon_s), settings)
+
+
+def test_alarming_within_cpa_distance(make_traffic_info, settings):
+    assert is_alarming(make_traffic_info(distance_m=1_000, speed_kmh=SPEED_KMH, track_dg=0), settings)
+
+
+def test_alarming_closing_within_max_distance(make_traffic_info, settings):
+    assert is_alarming(make_traffic_info(distance_m=9_000, bearing_dg=0, speed_kmh=SPEED_KMH, track_dg=180), settings)
+
+
+def test_alarming_closing_beyond_max_distance_on_collision_course(make_traffic_info, settings):
+    # Reaches ownship in 60 seconds
+    assert is_alarming(make_traffic_info(distance_m=12_000, bearing_dg=0, speed_kmh=2 * SPEED_KMH, track_dg=180), settings)
+
+
+def test_not_alarming_closing_beyond_max_distance(make_traffic_info, settings):
+    # Passes 5000 m abeam
+    assert not is_alarming(make_traffic_info(distance_m=13_000, bearing_dg=23, speed_kmh=SPEED_KMH, track_dg=180), settings)
+
+
+def test_not_alarming_moving_away(make_traffic_info, settings):
+    assert not is_alarming(make_traffic_info(distance_m=5_000, bearing_dg=0, speed_kmh=SPEED_KMH, track_dg=0), settings)
+
+
+def test_not_alarming_above_max_altitude(make_traffic_info, settings):
+    assert not is_alarming(make_traffic_info(distance_m=1_000, altitude_m=4_000), settings)
+
+
+def test_alarming_descending_into_max_altitude(make_traffic_info, settings):
+    traffic_info = make_traffic_info(distance_m=5_000, bearing_dg=0, speed_kmh=SPEED_KMH, track_dg=180, altitude_m=3_500, vertical_speed_ms=-20)
+
+    assert is_alarming(traffic_info, settings)
+
+
+def test_alarming_unknown_speed_while_ownship_moves_away(make_traffic_info, settings):
+    ownship = Velocity(track_dg=180, speed_kmh=SPEED_KMH, vertical_speed_ms=0)
+
+    assert is_alarming(make_traffic_info(distance_m=5_000, bearing_dg=0, speed_valid=False), settings, ownship)
@@ -0,0 +1,44 @@
+"""
+Screen rendering benchmarks, run with pytest-benchmark:
+    pytest tests/test_render_benchmark.py --benchmark-columns=mean,median,max,ops
+"""
+import pytest
+
+from stratux_companion.benchmark import SyntheticTraffic, SyntheticStatus
+from stratux_companion.display import create_dummy
+from stratux_companion.settings_service import Settings
+from stratux_companion.ui_service import TrafficScreen, AlarmScreen, StatusScreen
+
+_sources = {}
+
+
+def synthetic_traffic(targets: int) -> SyntheticTraffic:
+    """
+    Building 1000 target snapshots takes a while, so every source is built once per session
+    """
+    if targets not in _sources:
+        _sources[targets] = SyntheticTraffic(targets)
+    return _sources[targets]
+
+
+SCREENS = {
+    'traffic': lambda device, source, status: TrafficScreen(device=device, traffic_service=source),
+    'alarm': lambda device, source, status: AlarmScreen(device=device, alarm_service=source),
+    'status': lambda device, source, status: StatusScreen(device=device, position_service=status, hardware_status_service=status),
+}
+
+
+@pytest.mark.parametrize('targets', [0, 10, 100, 1000])
+@pytest.mark.parametrize('screen_name', list(SCREENS))
+def test_render(benchmark, screen_name, targets):
+    device = create_dummy(Settings())
+    source = synthetic_traffic(targets)
+    screen = SCREENS[screen_name](device, source, SyntheticStatus())
+
+    def frame():
+        # Same as UIServiceWorker.trigger, with traffic changing every frame
+        source.next()
+        if screen.update():
+            device.display(screen.image)
+
+    benchmark.pedantic(frame, rounds=200, warmup_rounds=20)
@@ -0,0 +1,40 @@
+import asyncio
+import sys
+import threading
+import time
+
+import pytest
+
+from stratux_companion.settings_watcher import SettingsWatcherWorker
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith('linux'), reason='inotify is Linux only')
+
+
+@pytest.fixture()
+def watcher(settings_service):
+    watcher = SettingsWatcherWorker(settings_service)
+    assert watcher._inotify is not None
+    return watcher
+
+
+def test_shutdown_interrupts_select(watcher):
+    thread = threading.Thread(target=watcher.run, daemon=True)
+    thread.start()
+    time.sleep(0.1)
+
+    start = time.monotonic()
+    watcher.shutdown()
+    thread.join(timeout=2)
+
+    assert not thread.is_alive()
+    assert time.monotonic() - start < 1
+
+
+def test_shutdown_interrupts_select_async(watcher):
+    async def run():
+        task = asyncio.ensure_future(watcher.run_async())
+        await asyncio.sleep(0.1)
+        watcher.shutdown()
+        await asyncio.wait_for(task, 1)
+
+    asyncio.run(run())
@@ -0,0 +1,53 @@
+from stratux_companion.traffic_index import TrafficIndex
+from stratux_companion.util import NS_PER_S
+
+
+def test_evicts_late_fix_behind_fresh_one(make_traffic_info):
+    index = TrafficIndex()
+    index.update(make_traffic_info('A', fix_s=0))
+    # Arrives later, but stratux has not heard from it for 25 seconds
+    index.update(make_traffic_info('B', fix_s=1 - 25))
+
+    evicted = index.evict_older_than(int(-20 * NS_PER_S))
+
+    assert [t.icao for t in evicted] == ['B']
+    assert index.get('A') is not None
+    assert index.get('B') is None
+
+
+def test_new_fix_postpones_eviction(make_traffic_info):
+    index = TrafficIndex()
+    index.update(make_traffic_info('A', fix_s=0))
+    index.update(make_traffic_info('A', fix_s=10))
+
+    assert index.evict_older_than(5 * NS_PER_S) == []
+    assert [t.icao for t in index.evict_older_than(11 * NS_PER_S)] == ['A']
+    assert len(index) == 0
+
+
+def test_removed_traffic_is_not_evicted(make_traffic_info):
+    index = TrafficIndex()
+    index.update(make_traffic_info('A', fix_s=0))
+    index.remove('A')
+
+    assert index.evict_older_than(NS_PER_S) == []
+
+
+def test_outdated_entries_are_compacted(make_traffic_info):
+    index = TrafficIndex()
+    for n in range(1_000):
+        index.update(make_traffic_info('A', fix_s=n))
+
+    assert len(index._by_fix) <= 4 * len(index) + 65
+    assert [t.fix_ns for t in index.evict_older_than(1_000 * NS_PER_S)] == [999 * NS_PER_S]
+
+
+def test_replace_all_keeps_fixes(make_traffic_info):
+    index = TrafficIndex()
+    index.update(make_traffic_info('A', fix_s=0, distance_m=100))
+    index.update(make_traffic_info('B', fix_s=-25, distance_m=200))
+
+    index.replace_all([t._replace(distance_m=1_000 - t.distance_m) for t in index])
+
+    assert [t.icao for t in index.closest()] == ['B', 'A']
+    assert [t.icao for t in index.evict_older_than(-20 * NS_PER_S)] == ['B']
@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+from stratux_companion.replay import plan_replay
+from stratux_companion.traffic_decoder import JsonTrafficDecoder
+from stratux_companion.traffic_service import TrafficServiceWorker
+from stratux_companion.util import GPS
+
+
+class StaticPosition:
+    def get_current_position(self) -> GPS:
+        return GPS(lat=30.45, lng=-97.68)
+
+
+def message(icao_addr: int, **fields) -> str:
+    return json.dumps({
+        'Icao_addr': icao_addr,
+        'Reg': 'N12345',
+        'Tail': 'N12345',
+        'Position_valid': True,
+        'Lat': 30.46,
+        'Lng': -97.69,
+        'Alt': 3000,
+        'Speed': 100,
+        'Speed_valid': True,
+        'Track': 180,
+        'Vvel': 0,
+        'Timestamp': '2024-01-12T05:30:20.777200261Z',
+        'Age': 0.5,
+        'AgeExtrapolation': 0.0,
+        'ExtrapolatedPosition': False,
+        **fields,
+    })
+
+
+@pytest.fixture
+def traffic_service(settings_service):
+    traffic_service = TrafficServiceWorker(settings_service=settings_service, position_service=StaticPosition())
+    # Stdlib decoder passes nulls through, the faster ones reject them while decoding
+    traffic_service._decoder = JsonTrafficDecoder()
+    return traffic_service
+
+
+def test_bad_message_does_not_drop_batch(traffic_service):
+    traffic_service._handle_traffic_messages([
+        message(1),
+        message(2, Age=None),
+        message(3, Lat=None),
+        message(4),
+    ])
+
+    assert sorted(t.icao for t in traffic_service.get_snapshot().traffic) == ['1', '4']
+    assert traffic_service.messages_seen == 4
+
+
+def test_skipped_messages_do_not_keep_icao_names(traffic_service):
+    traffic_service._handle_traffic_messages([message(n, Age=3600) for n in range(100)])
+
+    assert traffic_service.messages_outdated == 100
+    assert traffic_service._icao_names == {}
+
+    traffic_service._handle_traffic_messages([message(1)])
+
+    assert traffic_service._icao_names == {1: '1'}
+
+
+def test_replay_plan_agrees_with_service(traffic_service, settings_service):
+    settings = settings_service.get_settings()
+    # Wonky altitude counts as 0, so this target is alarming even though it reports to be far above
+    wonky = message(1, Lat=settings.default_position.lat + 0.01, Lng=settings.default_position.lng, Alt=60_000)
+
+    traffic_service._handle_traffic_messages([wonky])
+    [traffic_info] = traffic_service.get_snapshot().traffic
+    [planned] = plan_replay([wonky], settings, max_gap_s=1)
+
+    assert traffic_info.altitude_m == 0
+    assert planned.alarming
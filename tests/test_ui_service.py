@@ -0,0 +1,61 @@
+import tracemalloc
+
+import pytest
+
+from stratux_companion.benchmark import SyntheticTraffic, SyntheticStatus
+from stratux_companion.display import create_dummy
+from stratux_companion.settings_service import Settings
+from stratux_companion.ui_service import TrafficScreen, AlarmScreen, StatusScreen
+
+FRAMES = 100
+
+
+@pytest.fixture
+def device():
+    return create_dummy(Settings())
+
+
+@pytest.fixture
+def traffic():
+    return SyntheticTraffic(targets=10)
+
+
+@pytest.fixture(params=['traffic', 'alarm', 'status'])
+def screen(request, device, traffic):
+    status = SyntheticStatus()
+    return {
+        'traffic': lambda: TrafficScreen(device=device, traffic_service=traffic),
+        'alarm': lambda: AlarmScreen(device=device, alarm_service=traffic),
+        'status': lambda: StatusScreen(device=device, position_service=status, hardware_status_service=status),
+    }[request.param]()
+
+
+def test_first_frame_is_drawn(screen):
+    assert screen.update()
+
+
+def test_changed_traffic_is_redrawn(device, traffic):
+    screen = TrafficScreen(device=device, traffic_service=traffic)
+    screen.update()
+
+    traffic.next()
+    assert screen.update()
+
+
+def test_unchanged_frame_allocates_close_to_nothing(screen):
+    # First frames draw everything and fill caches
+    for _ in range(5):
+        screen.update()
+
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        for _ in range(FRAMES):
+            assert not screen.update()
+        after, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    # A single redrawn line image alone is about 6 KiB, unchanged frames only build their text lines
+    assert (after - before) / FRAMES < 100
+    assert peak - before < 16 * 1024